@@ -2,39 +2,188 @@
 
 """Reparse the schemas, rebuilding DTDs which are out of date.
 
+Usage:
+  CheckDtds.py [--full] [client-files-directory]
+
+A fingerprint of the schema documents each DTD was derived from is kept
+beside the client files directory, so only the document types whose
+schemas have changed since the last run are fetched and regenerated.
+Use --full to rebuild everything regardless.
+
 2021-12-10: added comments to suppress pylint errors (it's not smart enough
 to understand how setattr() works).
 """
 
+import hashlib
+import json
+import os
 import sys
 from lxml import etree
+from cdrapi import db
 import cdr
 
 LOGGER = cdr.Logging.get_logger("CheckDTDs", console=True)
 
-CLIENT_FILES_DIR = len(sys.argv) > 1 and sys.argv[1] or cdr.CLIENT_FILES_DIR
+ARGS = [arg for arg in sys.argv[1:] if not arg.startswith("--")]
+FULL = "--full" in sys.argv[1:]
+CLIENT_FILES_DIR = ARGS and ARGS[0] or cdr.CLIENT_FILES_DIR
+STATE_PATH = "%s.dtds.json" % os.path.abspath(CLIENT_FILES_DIR)
+XSD = "{http://www.w3.org/2001/XMLSchema}"
+INCLUDES = XSD + "include", XSD + "import", XSD + "redefine"
+
+
+def fetchDocTypes(docTypes):
+    """
+    Get the DTDs and the enumerated values for all the document types.
 
+    Instead of two server round trips for each document type, a single
+    command set carries a pair of CdrGetDocType commands for every type,
+    one for the DTD and one (without the DTD) for CdrDocTypes.xml.
 
-def getDocTypeResponses(docType):
-    opts = dict(Type=docType, OmitDtd="Y", GetEnumValues="Y")
-    cmd = etree.Element("CdrGetDocType", **opts)
+    Pass:
+      docTypes - sequence of document type names
+
+    Return:
+      dictionary of (dtd, response) tuples indexed by document type name
+      (the value is the exception instead for a type we couldn't get)
+    """
     commands = etree.Element("CdrCommandSet")
     etree.SubElement(commands, "SessionId").text = "guest"
-    wrapper = etree.SubElement(commands, "CdrCommand")
-    wrapper.append(cmd)
+    keys = []
+    for docType in docTypes:
+        for omit in ("N", "Y"):
+            key = "%s:%s" % (docType, omit)
+            keys.append(key)
+            opts = dict(Type=docType, GetEnumValues="Y")
+            if omit == "Y":
+                opts["OmitDtd"] = "Y"
+            wrapper = etree.SubElement(commands, "CdrCommand", CmdId=key)
+            etree.SubElement(wrapper, "CdrGetDocType", **opts)
     response = cdr._Control.send_commands(commands)
-    xml = etree.tostring(response.node, encoding="unicode")
+    nodes = {}
+    for i, node in enumerate(response.node.iter("CdrResponse")):
+        key = node.get("CmdId") or (keys[i] if i < len(keys) else None)
+        nodes[key] = node
+    results = {}
+    for docType in docTypes:
+        try:
+            dtdNode = nodes.get("%s:N" % docType)
+            if dtdNode is None:
+                raise Exception("CdrGetDocType FAILURE: no response")
+            getDocTypeResponse(dtdNode)
+            dtd = dtdNode.findtext(".//CdrGetDocTypeResp/DocDtd")
+            responseNode = nodes.get("%s:Y" % docType)
+            if responseNode is None:
+                raise Exception("CdrGetDocType FAILURE: no response")
+            results[docType] = dtd, getDocTypeResponse(responseNode)
+        except Exception as e:
+            results[docType] = e
+    return results
+
+
+def getDocTypeResponse(node):
+    xml = etree.tostring(node, encoding="unicode", with_tail=False)
     start = xml.find('<CdrGetDocTypeResp')
     if start < 0:
         sys.stderr.write("CdrGetDocType FAILURE: " + xml + "\n")
         raise Exception("CdrGetDocType FAILURE: " + xml)
     end = xml.find('</CdrGetDocTypeResp>')
-    if not end:
+    if end < 0:
         sys.stderr.write("CdrGetDocType FAILURE: " + xml + "\n")
         raise Exception("CdrGetDocType FAILURE: " + xml)
     return xml[start:end] + '</CdrGetDocTypeResp>\n'
 
 
+def getSchemaFingerprints():
+    """
+    Fingerprint the schemas from which each document type's DTD is built.
+
+    The fingerprint covers the document type's own row in the doc_type
+    table and the XML of its schema document, along with every schema
+    document that one includes, directly or indirectly.
+
+    Return:
+      dictionary of fingerprint strings indexed by document type name
+    """
+
+    conn = db.connect(user="CdrGuest")
+    try:
+        cursor = conn.cursor()
+        query = db.Query("document d", "d.id", "d.title", "d.xml")
+        query.join("doc_type t", "t.id = d.doc_type")
+        query.where("t.name = 'schema'")
+        schemaRows = query.execute(cursor).fetchall()
+        query = db.Query("doc_type", "*")
+        rows = query.execute(cursor).fetchall()
+        columns = [column[0].lower() for column in cursor.description]
+    finally:
+        conn.close()
+    titles = {}
+    schemas = {}
+    includes = {}
+    for docId, title, xml in schemaRows:
+        titles[docId] = title
+        schemas[title] = xml
+        includes[title] = getIncludes(xml)
+    fingerprints = {}
+    for row in rows:
+        values = dict(zip(columns, row))
+        seen = set()
+        pending = [titles.get(values.get("xml_schema"))]
+        while pending:
+            title = pending.pop()
+            if title and title not in seen:
+                seen.add(title)
+                pending.extend(includes.get(title, []))
+        sha = hashlib.sha256(repr(row).encode("utf-8"))
+        for title in sorted(seen):
+            sha.update(title.encode("utf-8"))
+            sha.update((schemas.get(title) or "").encode("utf-8"))
+        fingerprints[values.get("name")] = sha.hexdigest()
+    return fingerprints
+
+
+def getIncludes(xml):
+    """
+    Find the titles of the schema documents pulled in by a schema.
+    """
+
+    try:
+        root = etree.fromstring(xml.encode("utf-8"))
+    except Exception:
+        return []
+    includes = []
+    for node in root.iter():
+        if node.tag in INCLUDES and node.get("schemaLocation"):
+            includes.append(node.get("schemaLocation"))
+    return includes
+
+
+def getFileDigest(path):
+    try:
+        with open(path, "rb") as fp:
+            return hashlib.sha256(fp.read()).hexdigest()
+    except Exception:
+        return None
+
+
+def loadState():
+    try:
+        with open(STATE_PATH, encoding="utf-8") as fp:
+            return json.load(fp)
+    except Exception:
+        return {}
+
+
+def saveState(state):
+    try:
+        with open(STATE_PATH, "w", encoding="utf-8") as fp:
+            json.dump(state, fp, indent=2, sort_keys=True)
+    except Exception as e:
+        sys.stderr.write("failure writing %s: %s\n" % (STATE_PATH, e))
+        LOGGER.exception("failure writing %s", STATE_PATH)
+
+
 def saveDocTypeResponses(docTypeFilePath, docTypeResponses):
     with open(docTypeFilePath, 'w', encoding="utf-8") as fp:
         fp.write(docTypeResponses)
@@ -48,27 +197,63 @@ def loadDocTypeResponses(docTypeFilePath):
 directory = '%s/Rules' % CLIENT_FILES_DIR
 docTypeFileName = 'CdrDocTypes.xml'
 docTypeFilePath = '%s/%s' % (CLIENT_FILES_DIR, docTypeFileName)
-docTypes = cdr.getDoctypes('guest')
+docTypes = [docType for docType in cdr.getDoctypes('guest')
+            if docType.upper() not in ("FILTER", "CSS", "SCHEMA")]
+oldState = loadState()
+newState = {}
+unchanged = set()
+try:
+    fingerprints = getSchemaFingerprints()
+    fingerprinted = True
+except Exception as e:
+    LOGGER.exception("unable to fingerprint schemas; rebuilding all DTDs")
+    sys.stderr.write(str(e) + "\n")
+
+    # Rebuilding a DTD from the current schemas can't make the earlier
+    # fingerprint wrong, so carry it forward for the next run.
+    fingerprints = {}
+    for docType, prior in oldState.items():
+        fingerprints[docType] = prior.get("fingerprint")
+    fingerprinted = False
+if fingerprinted and not FULL:
+    for docType in docTypes:
+        prior = oldState.get(docType)
+        fingerprint = fingerprints.get(docType)
+        if prior and fingerprint and prior.get("fingerprint") == fingerprint:
+            path = "%s/%s.dtd" % (directory, docType)
+            if prior.get("dtd") == getFileDigest(path):
+                unchanged.add(docType)
+pending = [docType for docType in docTypes if docType not in unchanged]
+try:
+    fetched = fetchDocTypes(pending) if pending else {}
+except Exception as e:
+    LOGGER.exception("fetchDocTypes failure")
+    sys.stderr.write(str(e) + "\n")
+    sys.exit(1)
 docTypeResponses = ['<DocTypeResponses>\n']
 for docType in docTypes:
-    if docType.upper() in ("FILTER", "CSS", "SCHEMA"):
+    if docType in unchanged:
+        print("DTD for %25s  is current" % docType)
+        docTypeResponses.append(oldState[docType]["response"])
+        newState[docType] = oldState[docType]
         continue
     try:
-        dtInfo = cdr.getDoctype('guest', docType)
-        docTypeResponses.append(getDocTypeResponses(docType))
+        if isinstance(fetched[docType], Exception):
+            raise fetched[docType]
+        dtd, response = fetched[docType]
+        docTypeResponses.append(response)
         # sys.stderr.write("new DTD retrieved\n")
-        if not dtInfo.dtd:  # pylint: disable=no-member
+        if not dtd:
             sys.stderr.write("Can't get new DTD for %s\n" % repr(docType))
             LOGGER.warning("Can't get new DTD for %r", docType)
             continue
-        start = dtInfo.dtd.find("<!ELEMENT")  # pylint: disable=no-member
+        start = dtd.find("<!ELEMENT")
         # sys.stderr.write("new start is at %d\n" % start)
         if start == -1:
             sys.stderr.write("Malformed DTD for %s type\n" % repr(docType))
             LOGGER.warning("Malformed DTD for %r type", docType)
-            # print dtInfo.dtd
             continue
-        newDtd = dtInfo.dtd[start:]  # pylint: disable=no-member
+        newDtd = dtd[start:]
         path = "%s/%s.dtd" % (directory, docType)
         # sys.stderr.write("checking %s\n" % path)
         try:
@@ -87,13 +272,23 @@ for docType in docTypes:
             current = current[start:]
             if newDtd == current:
                 print("DTD for %25s  is current" % docType)
+                newState[docType] = dict(
+                    fingerprint=fingerprints.get(docType),
+                    response=response,
+                    dtd=getFileDigest(path),
+                )
                 continue
             else:
                 print("DTD for %25s has changed" % docType)
         else:
             print("DTD for %25s     added" % docType)
         try:
-            open(path, "w").write(dtInfo.dtd)  # pylint: disable=no-member
+            open(path, "w").write(dtd)
+            newState[docType] = dict(
+                fingerprint=fingerprints.get(docType),
+                response=response,
+                dtd=getFileDigest(path),
+            )
         except Exception as e:
             sys.stderr.write("failure writing %s: %s\n" % (path, e))
             LOGGER.exception("failure writing %s", path)
@@ -101,6 +296,7 @@ for docType in docTypes:
         LOGGER.exception("loadDocTypeResponses failure")
         sys.stderr.write(str(e) + "\n")
 
+saveState(newState)
 docTypeResponses.append('</DocTypeResponses>\n')
 docTypeResponses = "".join(docTypeResponses)
 try:
@@ -2,18 +2,43 @@
 # ----------------------------------------------------------------------
 # Rebuilds the manifest used to keep CDR client files up-to-date.
 # Rewrite of original utility by Jeff Holmes 2002-05-14.
+#
+# Usage:
+#   RefreshManifest.py [--delta] [client-files-directory]
+#
+# With --delta, the previous manifest is compared with the new one,
+# and a delta document listing the added, changed, and removed files
+# is written, along with a zip bundle holding only the new and changed
+# files (and the new manifest), so out-of-date clients can catch up
+# with a single download. A copy of each manifest written is kept
+# beside the client files area, so the comparison can still be made
+# after a deployment has replaced the area (and the manifest in it).
 # ----------------------------------------------------------------------
 import cdr
 import hashlib
+import json
 import lxml.etree as etree
 import platform
+import shutil
 import sys
 import socket
 import os
+import threading
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from queue import Queue
 
-CLIENT_FILES_DIR = len(sys.argv) > 1 and sys.argv[1] or cdr.CLIENT_FILES_DIR
+ARGS = [arg for arg in sys.argv[1:] if not arg.startswith("--")]
+DELTA = "--delta" in sys.argv[1:]
+CLIENT_FILES_DIR = ARGS and ARGS[0] or cdr.CLIENT_FILES_DIR
 MANIFEST_PATH = f"{CLIENT_FILES_DIR}/{cdr.MANIFEST_NAME}"
+INDEX_PATH = f"{os.path.abspath(CLIENT_FILES_DIR)}.index.json"
+DELTA_DIR = f"{os.path.abspath(CLIENT_FILES_DIR)}.deltas"
+PREVIOUS_PATH = f"{os.path.abspath(CLIENT_FILES_DIR)}.manifest.xml"
 IS_WINDOWS = True if "windows" in platform.platform().lower() else False
+CHUNK_SIZE = 1024 * 1024
+READ_AHEAD = 8
+HASHERS = os.cpu_count() or 1
 
 
 class File:
@@ -31,10 +56,26 @@ class File:
     been constructed and sorted.
 
     2016-04-05: Eliminating timestamps as promised.
+
+    We do capture the size and modification time of each file (though
+    they don't go into the manifest), so we can tell which files have
+    changed since the last time the manifest was built.
     """
     def __init__(self, path):
         self.name = path
         self.key = self.name.lower()  # for sorting
+        try:
+            stat = os.stat(path)
+            self.size, self.mtime = stat.st_size, stat.st_mtime_ns
+        except FileNotFoundError:
+            self.size = self.mtime = None  # the manifest itself
+
+    def unchanged(self, index):
+        "Check the file's size and timestamp against the index."
+        entry = index.get("files", {}).get(self.name)
+        if not entry:
+            return False
+        return entry["size"] == self.size and entry["mtime"] == self.mtime
 
     def __lt__(self, other):
         "Compare by file names, ignoring case."
@@ -55,7 +96,7 @@ def gather_files(dir_path):
     return files
 
 
-def create_ticket(md5):
+def create_ticket(checksum):
     """
     Create a block for the manifest which can be used for a quick
     determination that at least one file is different (or missing)
@@ -68,37 +109,259 @@ def create_ticket(md5):
     etree.SubElement(ticket, "Application").text = sys.argv[0]
     etree.SubElement(ticket, "Host").text = str(host)
     etree.SubElement(ticket, "Author").text = str(os.environ["USERNAME"])
-    etree.SubElement(ticket, "Checksum").text = md5.hexdigest().lower()
+    etree.SubElement(ticket, "Checksum").text = checksum
     return ticket
 
 
-def md5(file_bytes):
+def read_chunks(files, chunks):
+    """
+    Read the files in order, handing their bytes to the main thread.
+
+    The queue is bounded, so no more than READ_AHEAD chunks are held in
+    memory at once. A chunk of None marks the end of a file; a final
+    (None, None) marks the end of the list (or carries the exception
+    which stopped the reading).
+    """
+    try:
+        for f in files:
+            with open(f.name, "rb") as fp:
+                chunk = fp.read(CHUNK_SIZE)
+                while chunk:
+                    chunks.put((f, chunk))
+                    chunk = fp.read(CHUNK_SIZE)
+            chunks.put((f, None))
+        chunks.put((None, None))
+    except Exception as e:
+        chunks.put((None, e))
+
+
+def hash_file(path):
+    """
+    Read a file and return its checksum.
+    """
+    file_md5 = hashlib.md5()
+    with open(path, "rb") as fp:
+        chunk = fp.read(CHUNK_SIZE)
+        while chunk:
+            file_md5.update(chunk)
+            chunk = fp.read(CHUNK_SIZE)
+    return file_md5.hexdigest().lower()
+
+
+def hash_chunks(chunks):
     """
-    Generate a checksum for the bytes from a file; used to detect when
-    a file has changed.
+    Return the checksum for the bytes queued for a single file.
+
+    A chunk of None marks the end of the file.
     """
-    m = hashlib.md5()
-    m.update(file_bytes)
-    return m.hexdigest().lower()
+    file_md5 = hashlib.md5()
+    chunk = chunks.get()
+    while chunk is not None:
+        file_md5.update(chunk)
+        chunk = chunks.get()
+    return file_md5.hexdigest().lower()
 
 
-def create_filelist(files, manifest_md5):
+def create_filelist(files, manifest_md5, index=None):
     """
     Create a block for the manifest with a list of information for each
     of the files in the client area.
+
+    Checksums for files which haven't changed since the last run are
+    taken from the index, and the rest are calculated by a pool of
+    worker threads, one file per worker (`hashlib` releases the GIL
+    while it works, so they run in parallel on all of the cores).
+
+    The cumulative checksum (if requested) must be fed with the bytes
+    of every file in sorted order to stay the same as the checksum
+    produced by a full rebuild. In that case each file is read exactly
+    once, in that order, by a separate thread; the main thread feeds
+    the chunks to the cumulative checksum and hands the chunks of each
+    file needing its own checksum to the worker calculating it. The
+    queues are bounded, so only a few chunks are in memory at once.
     """
+    index = index or {}
+    hashed = [f for f in files if cdr.MANIFEST_NAME not in f.name]
+    pending = []
+    for f in hashed:
+        if f.unchanged(index):
+            f.checksum = index["files"][f.name]["checksum"]
+        else:
+            pending.append(f)
+    with ThreadPoolExecutor(max_workers=HASHERS) as executor:
+        if manifest_md5 is None:
+            names = [f.name for f in pending]
+            for f, checksum in zip(pending, executor.map(hash_file, names)):
+                f.checksum = checksum
+        elif hashed:
+            chunks = Queue(maxsize=READ_AHEAD)
+            args = hashed, chunks
+            reader = threading.Thread(target=read_chunks, args=args,
+                                      daemon=True)
+            reader.start()
+            pending = set(pending)
+            futures = {}
+            current = file_chunks = None
+            try:
+                while True:
+                    f, chunk = chunks.get()
+                    if f is None:
+                        if chunk is not None:
+                            raise chunk
+                        break
+                    if f is not current:
+                        current = f
+                        if f in pending:
+                            file_chunks = Queue(maxsize=READ_AHEAD)
+                            future = executor.submit(hash_chunks, file_chunks)
+                            futures[f] = future
+                    if file_chunks is not None:
+                        file_chunks.put(chunk)
+                        if chunk is None:
+                            file_chunks = None
+                    if chunk is not None:
+                        manifest_md5.update(chunk)
+            finally:
+                if file_chunks is not None:
+                    file_chunks.put(None)
+            reader.join()
+            for f, future in futures.items():
+                f.checksum = future.result()
     wrapper = etree.Element("FileList")
     for f in files:
         child = etree.SubElement(wrapper, "File")
         etree.SubElement(child, "Name").text = f.name
         if cdr.MANIFEST_NAME not in f.name:
-            with open(f.name, "rb") as fp:
-                file_bytes = fp.read()
-            etree.SubElement(child, "Checksum").text = md5(file_bytes)
-            manifest_md5.update(file_bytes)
+            etree.SubElement(child, "Checksum").text = f.checksum
     return wrapper
 
 
+def load_index():
+    """
+    Fetch the information saved by the last run about the client files.
+
+    The index lives outside the client files area, so it doesn't get
+    picked up as one of the files to be sent to the clients.
+    """
+    try:
+        with open(INDEX_PATH, encoding="utf-8") as fp:
+            return json.load(fp)
+    except Exception:
+        return {}
+
+
+def index_is_current(files, index):
+    """
+    Determine whether we can reuse everything from the last run.
+
+    This is true when the same files are present, and none of them
+    has a different size or timestamp from the one in the index.
+    """
+    if not index.get("checksum"):
+        return False
+    names = {f.name for f in files if cdr.MANIFEST_NAME not in f.name}
+    if names != set(index.get("files", {})):
+        return False
+    for f in files:
+        if cdr.MANIFEST_NAME not in f.name and not f.unchanged(index):
+            return False
+    return True
+
+
+def save_index(files, checksum):
+    """
+    Remember the sizes, timestamps, and checksums for the next run.
+    """
+    index = dict(checksum=checksum, files={})
+    for f in files:
+        if cdr.MANIFEST_NAME not in f.name:
+            info = dict(size=f.size, mtime=f.mtime, checksum=f.checksum)
+            index["files"][f.name] = info
+    try:
+        with open(INDEX_PATH, "w", encoding="utf-8") as fp:
+            json.dump(index, fp, indent=1)
+    except Exception as e:
+        print(f"unable to save {INDEX_PATH}: {e}")
+
+
+def load_manifest():
+    """
+    Fetch the cumulative checksum and the file checksums from the
+    manifest we're about to replace, so we can tell what changed.
+
+    The copy saved outside the client files area by the last run is
+    used if there is one, because a deployment replaces the manifest
+    in the area with the one built for the new release. Returns None
+    if there is no usable previous manifest.
+    """
+    root = None
+    for path in (PREVIOUS_PATH, MANIFEST_PATH):
+        try:
+            root = etree.parse(path).getroot()
+            break
+        except Exception:
+            pass
+    if root is None:
+        return None
+    checksums = {}
+    for node in root.findall("FileList/File"):
+        name = node.findtext("Name")
+        checksum = node.findtext("Checksum")
+        if name and checksum:
+            checksums[name] = checksum
+    return root.findtext("Ticket/Checksum"), checksums
+
+
+def create_delta(previous, files, checksum):
+    """
+    Write the delta document and the bundle of changed files.
+
+    Both are written outside the client files area, named for the
+    cumulative checksums of the old and new manifests, so a client
+    can find the delta which takes it from the manifest it has to
+    the current one. The bundle also carries the new manifest, so
+    the client ends up with the one matching its files. Nothing is
+    written if nothing changed.
+    """
+    old_checksum, old_files = previous
+    if old_checksum == checksum:
+        print("no client file changes for delta")
+        return
+    new_files = {f.name: f.checksum for f in files
+                 if cdr.MANIFEST_NAME not in f.name}
+    added = [name for name in new_files if name not in old_files]
+    changed = [name for name in new_files
+               if name in old_files and old_files[name] != new_files[name]]
+    removed = sorted(name for name in old_files if name not in new_files)
+    stem = f"{old_checksum}-{checksum}"
+    bundle_name = f"delta-{stem}.zip"
+    root = etree.Element("ManifestDelta")
+    etree.SubElement(root, "From").text = old_checksum
+    etree.SubElement(root, "To").text = checksum
+    etree.SubElement(root, "Bundle").text = bundle_name
+    for tag, names in (("Added", added), ("Changed", changed)):
+        wrapper = etree.SubElement(root, tag)
+        for name in names:
+            child = etree.SubElement(wrapper, "File")
+            etree.SubElement(child, "Name").text = name
+            etree.SubElement(child, "Checksum").text = new_files[name]
+    wrapper = etree.SubElement(root, "Removed")
+    for name in removed:
+        child = etree.SubElement(wrapper, "File")
+        etree.SubElement(child, "Name").text = name
+    os.makedirs(DELTA_DIR, exist_ok=True)
+    bundle_path = os.path.join(DELTA_DIR, bundle_name)
+    with zipfile.ZipFile(bundle_path, "w", zipfile.ZIP_DEFLATED) as bundle:
+        for name in added + changed + [cdr.MANIFEST_NAME]:
+            arcname = os.path.normpath(name).replace(os.path.sep, "/")
+            bundle.write(name, arcname)
+    xml = etree.tostring(root, pretty_print=True, encoding="unicode")
+    with open(os.path.join(DELTA_DIR, f"delta-{stem}.xml"), "w") as fp:
+        fp.write(xml)
+    args = len(added), len(changed), len(removed), DELTA_DIR
+    print("delta: %d added, %d changed, %d removed (in %s)" % args)
+
+
 def write_manifest(manifest_xml):
     """
     Serialize the manifest file to disk.
@@ -108,9 +371,16 @@ def write_manifest(manifest_xml):
     has been deployed to all of the tiers.
 
     2016-04-05: date/time stamp dropped as promised.
+
+    A copy is saved outside the client files area for the next run
+    to compare against.
     """
     with open(MANIFEST_PATH, "w") as fp:
         fp.write(manifest_xml)
+    try:
+        shutil.copyfile(MANIFEST_PATH, PREVIOUS_PATH)
+    except Exception as e:
+        print(f"unable to save {PREVIOUS_PATH}: {e}")
 
 
 def refresh_manifest(where):
@@ -121,10 +391,13 @@ def refresh_manifest(where):
        2. Switch the current directory to the client files area.
        3. Collect File objects for the files in this area.
        4. Add a File object for the manifest file we're creating.
-       5. Calculate the checksums for the files.
+       5. Calculate the checksums for the files (or reuse the ones
+          from the last run if no files have changed since then).
        6. Serialize the manifest to disk.
-       7. Adjust the permissions for the client area files/directories.
+       7. Write the delta from the previous manifest if requested.
+       8. Adjust the permissions for the client area files/directories.
     """
+    previous = load_manifest() if DELTA else None
     try:
         os.unlink(MANIFEST_PATH)
     except Exception:
@@ -132,13 +405,24 @@ def refresh_manifest(where):
     os.chdir(where)
     files = gather_files(".")
     files.append(File(os.path.join(".", cdr.MANIFEST_NAME)))
-    md5 = hashlib.md5()
-    filelist = create_filelist(sorted(files), md5)
+    files = sorted(files)
+    index = load_index()
+    if index_is_current(files, index):
+        print("client files unchanged since last manifest")
+        filelist = create_filelist(files, None, index)
+        checksum = index["checksum"]
+    else:
+        md5 = hashlib.md5()
+        filelist = create_filelist(files, md5, index)
+        checksum = md5.hexdigest().lower()
+        save_index(files, checksum)
     root = etree.Element("Manifest")
-    root.append(create_ticket(md5))
+    root.append(create_ticket(checksum))
     root.append(filelist)
     xml = etree.tostring(root, pretty_print=True, encoding="unicode")
     write_manifest(xml)
+    if previous:
+        create_delta(previous, files, checksum)
     if IS_WINDOWS:
         command = f"{cdr.BASEDIR}/bin/fix-permissions.cmd {CLIENT_FILES_DIR}"
         command = command.replace("/", os.path.sep)
@@ -20,11 +20,15 @@ JIRA::OCECDR-4300 - rewrite for Jenkins/GitHub (Bob Kline, September 2017)
 
 import argparse
 import datetime
+import hashlib
+import json
 import logging
 import os
 import shutil
 import subprocess
 import sys
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from cdrapi import db
 
 
 class Control:
@@ -33,6 +37,7 @@ class Control:
 
     Class values:
       SCRIPTS - directory where the build scripts are stored
+      MANIFEST - name of the file listing the checksums for the build
       POPEN_OPTS - options for launching a sub process
 
     Attributes:
@@ -43,6 +48,7 @@ class Control:
     """
 
     SCRIPTS = os.path.split(os.path.abspath(sys.argv[0]))[0]
+    MANIFEST = "MANIFEST.json"
     POPEN_OPTS = dict(
         shell=True,
         stdout=subprocess.PIPE,
@@ -66,12 +72,88 @@ class Control:
 
         self.fetch_branch()
         os.chdir(self.opts.base)
-        for directory in self.dirs:
-            directory.build(self)
-            self.logger.info("built %s", directory.name)
+        self.build()
+        self.write_manifest()
         self.cleanup()
         self.logger.info("build complete")
 
+    def build(self):
+        """
+        Build the directories, several at a time if requested.
+
+        The directories don't depend on each other, so they can be
+        built concurrently. The ClientFiles build takes much longer
+        than any of the others, so we start it first, giving the
+        other directories a chance to be copied while it runs.
+        If any of the directories fail, the others are allowed
+        to finish before we report the failures and exit.
+        """
+
+        failures = []
+        hits = misses = 0
+        dirs = sorted(self.dirs, key=lambda d: d.script is None)
+        with ThreadPoolExecutor(max_workers=self.opts.jobs) as executor:
+            futures = {}
+            for directory in dirs:
+                futures[executor.submit(directory.build, self)] = directory
+            for future in as_completed(futures):
+                directory = futures[future]
+                try:
+                    if future.result():
+                        hits += 1
+                    else:
+                        misses += 1
+                    self.logger.info("built %s", directory.name)
+                except Exception:
+                    self.logger.exception("failure building %s",
+                                          directory.name)
+                    failures.append(directory.name)
+        if self.opts.cache:
+            self.logger.info("build cache: %d hits, %d misses", hits, misses)
+        if failures:
+            self.logger.error("build failed for %s", " ".join(failures))
+            sys.exit(1)
+
+    def write_manifest(self):
+        """
+        Record the size, timestamp, and checksum of every file in the build.
+
+        The files are hashed by a pool of worker threads. The manifest
+        is written to the top of the build set, with the files listed
+        by directory, using relative paths with forward slashes. The
+        deployment script uses the checksums to avoid reading the
+        files in the build set a second time when deciding which
+        files have changed, trusting a checksum only if the file's
+        size and modification time (in whole seconds, as for the
+        deployment script's other timestamp checks) still match.
+        """
+
+        self.logger.info("calculating checksums")
+        files = []
+        for directory in self.dirs:
+            top = os.path.join(self.opts.base, directory.name)
+            for base, dirs, names in os.walk(top):
+                for name in names:
+                    path = os.path.join(base, name)
+                    relpath = os.path.relpath(path, top).replace("\\", "/")
+                    files.append((directory.name, relpath, path))
+        paths = [path for name, relpath, path in files]
+        with ThreadPoolExecutor() as executor:
+            digests = list(executor.map(Directory.digest, paths))
+        manifest = dict(branch=self.opts.branch, directories={})
+        for (name, relpath, path), digest in zip(files, digests):
+            if name not in manifest["directories"]:
+                manifest["directories"][name] = {}
+            stat = os.stat(path)
+            info = dict(size=stat.st_size, mtime=int(stat.st_mtime),
+                        sha256=digest)
+            manifest["directories"][name][relpath] = info
+        path = os.path.join(self.opts.base, self.MANIFEST)
+        with open(path, "w", encoding="utf-8") as fp:
+            json.dump(manifest, fp, indent=2, sort_keys=True)
+        self.logger.info("wrote checksums for %d files to %s", len(files),
+                         self.MANIFEST)
+
     def fetch_branch(self):
         """
         Pull down the files from this branch of the CDR repositories.
@@ -82,13 +164,30 @@ class Control:
             os.makedirs(path)
         script = os.path.join(self.SCRIPTS, "fetch-branch.cmd")
         args = script, self.opts.branch, path
-        p = subprocess.Popen(args, **self.POPEN_OPTS)
-        output, error = p.communicate()
-        if p.returncode:
-            self.logger.error("failure fetching branch: {}".format(output))
+        if self.stream(args, "fetch-branch"):
+            self.logger.error("failure fetching branch")
             sys.exit(1)
         self.logger.info("fetched files for %s", self.opts.branch)
 
+    def stream(self, args, label):
+        """
+        Run an external program, logging its output as it arrives.
+
+        Pass:
+          args - sequence of command-line arguments
+          label - string identifying the output's source in the log
+
+        Return:
+          the program's exit code
+        """
+
+        p = subprocess.Popen(args, **self.POPEN_OPTS)
+        for line in p.stdout:
+            line = line.decode("utf-8", errors="replace").rstrip()
+            if line:
+                self.logger.info("%s: %s", label, line)
+        return p.wait()
+
     def fetch_options(self):
         """
         Parse and validate the command-line arguments.
@@ -99,6 +198,10 @@ class Control:
 
         parser = self.make_argument_parser()
         opts = parser.parse_args()
+        if opts.jobs < 1:
+            parser.error("--jobs must be at least 1")
+        if opts.cache:
+            opts.cache = os.path.abspath(opts.cache)
         if "{branch}" in opts.base:
             opts.base = opts.base.format(branch=opts.branch)
         keys = dict([(d.name.lower(), d) for d in self.dirs])
@@ -142,6 +245,11 @@ class Control:
         parser.add_argument("-b", "--base", default=base, help="output base")
         parser.add_argument("-l", "--logpath", default=logpath,
                             help="where to record what we do")
+        parser.add_argument("-j", "--jobs", type=int, default=1,
+                            help="number of directories to build at once")
+        parser.add_argument("-c", "--cache", metavar="DIRECTORY",
+                            help="reuse directories built from the same "
+                            "source files")
         group = parser.add_mutually_exclusive_group()
         group.add_argument("-i", "--include", nargs="*",
                            help="directories to build")
@@ -179,6 +287,9 @@ class Control:
         log_path = os.path.normpath(self.opts.logpath).replace("\\", "/")
         logger.info("building %s", build_path)
         logger.info("logging to %s", log_path)
+        if self.opts.cache:
+            cache_path = os.path.normpath(self.opts.cache).replace("\\", "/")
+            logger.info("using build cache %s", cache_path)
         if self.opts.exclude:
             logger.info("excluding %s", " ".join(self.opts.exclude))
         elif self.opts.include:
@@ -221,14 +332,22 @@ class Directory:
 
     Class values:
       BUILD_CLI - script to build the ClientFiles directory
+      CLI_INPUTS - portions of the branch used to build ClientFiles
+      BLOCK_SIZE - number of bytes to read at a time when hashing
 
     Attributes:
       name - the name of the directory to be built
       source - relative path for the directory in the set
                pulled down from GitHub
+      script - name of the batch file which builds the directory
+               (None if the directory is simply copied)
+      inputs - relative paths of the portions of the branch from
+               which the directory is built
     """
 
     BUILD_CLI = "build-client-files.cmd"
+    CLI_INPUTS = "client/XMetaL", "tools/Build", "server/Schemas"
+    BLOCK_SIZE = 1024 * 1024
 
     def __init__(self, name, source=None):
         """
@@ -237,35 +356,167 @@ class Directory:
 
         self.name = name
         self.source = source
+        self.script = self.BUILD_CLI if name == "ClientFiles" else None
+        self.inputs = self.CLI_INPUTS if self.script else (source,)
 
     def build(self, control):
         """
         Install this directory's portion of the build.
 
+        If a build cache is in use, and this directory has already
+        been built from exactly the same source files, we link (or
+        copy) the cached results instead of building the directory
+        again. Otherwise, a successful build is added to the cache.
+
+        The DTDs and CdrDocTypes.xml in ClientFiles are generated from
+        the document types and schemas stored in the CDR on the build
+        server, not from the branch, so the state of those is part of
+        the ClientFiles fingerprint. If it can't be determined, the
+        directory is built without using the cache.
+
+        Return:
+          True if the directory was found in the cache
+        """
+
+        target = os.path.join(control.opts.base, self.name)
+        cached = None
+        key = None
+        if control.opts.cache:
+            try:
+                key = self.fingerprint(control)
+            except Exception:
+                message = "can't fingerprint %s; not using the cache"
+                control.logger.exception(message, self.name)
+        if key:
+            cached = os.path.join(control.opts.cache, self.name, key)
+            if os.path.isdir(cached):
+                shutil.copytree(cached, target, copy_function=self.link)
+                control.logger.info("cache hit for %s (%s)", self.name, key)
+                return True
+            control.logger.info("cache miss for %s (%s)", self.name, key)
+        self.make(control)
+        if cached:
+            working = cached + ".tmp"
+            if os.path.isdir(working):
+                shutil.rmtree(working)
+            shutil.copytree(target, working, copy_function=self.link)
+            os.rename(working, cached)
+        return False
+
+    def make(self, control):
+        """
+        Assemble the directory from the files pulled from GitHub.
+
         The ClientFiles directory requires more complicated
         compilation and post-processing tasks, so we farm out the work
         to a separate command shell batch file. We can handle all the
         other directories by simply making a recursive copy of the
         files from the set retrieved from GitHub.
 
+        The output from the batch file is written to the log as
+        it is produced, so we can follow the progress of the build.
         """
 
-        drive = control.drive
         base = os.path.normpath(control.opts.base)
-        script = None
-        if self.name == "ClientFiles":
-            script = os.path.join(control.SCRIPTS, self.BUILD_CLI)
-            args = script, base
+        if self.script:
+            args = os.path.join(control.SCRIPTS, self.script), base
+            code = control.stream(args, self.name)
+            if code:
+                raise Exception(f"{self.script} returned {code}")
         else:
             source = os.path.join(control.opts.base, "branch", self.source)
             target = os.path.join(control.opts.base, self.name)
             shutil.copytree(source, target)
-        if script is not None:
-            p = subprocess.Popen(args, **control.POPEN_OPTS)
-            output, error = p.communicate()
-            if p.returncode:
-                control.logger.error("{}: {}".format(self.name, output))
-                sys.exit(1)
+
+    def fingerprint(self, control):
+        """
+        Create a hash of the source files from which this directory is built.
+
+        The hash covers the relative paths and the content of every
+        file in the portions of the branch used for the directory.
+        This must be done before the directory is built, because
+        the ClientFiles build moves its files out of the branch.
+        For ClientFiles, the hash also covers the document types and
+        schemas in the CDR database from which the DTDs are built.
+
+        Return:
+          hex string for the SHA-256 digest of the source files
+        """
+
+        branch = os.path.join(control.opts.base, "branch")
+        sha256 = hashlib.sha256(self.name.encode("utf-8"))
+        for source in self.inputs:
+            for base, dirs, files in os.walk(os.path.join(branch, source)):
+                dirs.sort()
+                for name in sorted(files):
+                    path = os.path.join(base, name)
+                    relpath = os.path.relpath(path, branch).replace("\\", "/")
+                    digest = self.digest(path)
+                    sha256.update(f"{relpath}\0{digest}\n".encode("utf-8"))
+        if self.script:
+            sha256.update(self.schema_state().encode("utf-8"))
+        return sha256.hexdigest()
+
+    @staticmethod
+    def schema_state():
+        """
+        Capture the CDR document type and schema information for the DTDs.
+
+        CheckDtds.py builds the client DTDs from the doc_type table and
+        the Schema documents on this server, so two builds of the same
+        branch can produce different ClientFiles if those differ.
+
+        Return:
+          hex string for the SHA-256 digest of the doc_type rows and
+          the titles and XML of all the schema documents
+        """
+
+        conn = db.connect(user="CdrGuest")
+        try:
+            cursor = conn.cursor()
+            sha256 = hashlib.sha256()
+            query = db.Query("doc_type", "*").order("name")
+            for row in query.execute(cursor).fetchall():
+                sha256.update(repr(tuple(row)).encode("utf-8"))
+            query = db.Query("document d", "d.id", "d.title", "d.xml")
+            query.join("doc_type t", "t.id = d.doc_type")
+            query.where("t.name = 'schema'")
+            query.order("d.id")
+            for doc_id, title, xml in query.execute(cursor).fetchall():
+                values = f"{doc_id}\0{title}\0{xml}\n"
+                sha256.update(values.encode("utf-8"))
+            return sha256.hexdigest()
+        finally:
+            conn.close()
+
+    @classmethod
+    def digest(cls, path):
+        """
+        Calculate the SHA-256 checksum for a file's content.
+        """
+
+        sha256 = hashlib.sha256()
+        with open(path, "rb") as fp:
+            block = fp.read(cls.BLOCK_SIZE)
+            while block:
+                sha256.update(block)
+                block = fp.read(cls.BLOCK_SIZE)
+        return sha256.hexdigest()
+
+    @staticmethod
+    def link(source, target):
+        """
+        Hard-link a file if possible, otherwise copy it.
+
+        Used for copying directories into and out of the build cache.
+        Linking saves time and disk space, but won't work across
+        disk volumes.
+        """
+
+        try:
+            os.link(source, target)
+        except OSError:
+            shutil.copy2(source, target)
 
     def __lt__(self, other):
         """
@@ -6,14 +6,25 @@ Compare a CDR build package with the live file system.
 Note that there are separate utilities in the DevTools directory
 for comparing Filters and Schemas against the live repository.
 
+The comparison used to be done by invoking `diff -r` for each of
+the top-level directories. It is now done in-process, so we don't
+depend on having GNU diff installed, and we only produce textual
+differences for files which actually differ. The output follows
+the format of the reports produced by `diff -r`.
+
 OCECDR-4300
 """
 
 import argparse
+import datetime
+import fnmatch
+import hashlib
+import json
 import os
 import re
-import subprocess
 import sys
+from concurrent.futures import ThreadPoolExecutor
+from difflib import SequenceMatcher
 
 
 class Control:
@@ -23,23 +34,20 @@ class Control:
     Class values:
       SCRIPTS - directory where the build scripts are stored
       EXCLUDES - location of file identifying things we don't check
+      MANIFEST - name of the build's file listing checksums
       SKIP - directories we don't check with this tool
-      POPEN_OPTS - options for launching a sub process
 
     Attributes:
       drive - letter representing the disk volume for the CDR
       opts - runtime control settings
+      excludes - patterns for file names we don't compare
+      manifest - checksums recorded by the build script
     """
 
     SCRIPTS = os.path.split(os.path.abspath(sys.argv[0]))[0]
     EXCLUDES = os.path.join(SCRIPTS, "diff.excludes").replace("\\", "/")
+    MANIFEST = "MANIFEST.json"
     SKIP = "Schemas", "Emailers"
-    POPEN_OPTS = dict(
-        shell=True,
-        text=True,
-        stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE
-    )
 
     def __init__(self):
         """
@@ -48,65 +56,58 @@ class Control:
 
         self.drive = self.find_cdr_drive()
         self.opts = self.fetch_options()
+        self.excludes = self.load_excludes()
+        self.manifest = self.load_manifest()
 
     def run(self):
         """
         Compare all the directories.
 
-        We only do a single iteration of the outer loop, because
-        we empty out the `dirs` sequence, which leaves the `walk()`
-        method nothing to recurse with.
-
-        Start by building up the arguments for the diff invocations,
-        adding two None placeholders for the source and target dirs.
+        The top-level directories are compared in parallel, but the
+        reports are written in the order in which the directories
+        are found in the build set.
         """
 
-        args = ["diff", "-r"]
-        if not self.opts.all:
-            args += ["-X", self.EXCLUDES]
-        if self.opts.brief:
-            args.append("-q")
-        if self.opts.ignore_space_change:
-            args.append("-b")
-        if self.opts.ignore_all_space:
-            args.append("-w")
-        if self.opts.ignore_case:
-            args.append("-i")
-        if self.opts.unified:
-            args.append("-u")
-        if self.opts.context:
-            args.append("-c")
-        args += [None, None]
-        for path, dirs, files in os.walk(self.opts.build):
-            while dirs:
-                directory = dirs.pop(0)
-                source = os.path.join(path, directory)
-                if directory in self.SKIP:
+        comparisons = []
+        with os.scandir(self.opts.build) as entries:
+            for entry in sorted(entries, key=lambda entry: entry.name):
+                if not entry.is_dir() or entry.name in self.SKIP:
                     continue
-                elif directory == 'Inetpub':
+                if entry.name == "Inetpub":
                     target = self.drive + ":/Inetpub"
                 else:
-                    target = self.drive + ":/cdr/" + directory
-                args[-2:] = source.replace("\\", "/"), target
-                p = subprocess.Popen(args, **self.POPEN_OPTS)
-                output, errout = p.communicate()
-                if errout:
-                    raise Exception(errout)
-                sys.stdout.write(self.filtered(output))
+                    target = self.drive + ":/cdr/" + entry.name
+                source = entry.path.replace("\\", "/")
+                comparisons.append(Comparison(self, entry.name, source,
+                                              target))
+        with ThreadPoolExecutor(max_workers=self.opts.jobs) as executor:
+            for report in executor.map(Comparison.run, comparisons):
+                sys.stdout.write(report)
 
-    def filtered(self, output):
+    def load_excludes(self):
         """
-        Prepare the diff output for display.
+        Fetch the patterns for files we don't compare.
 
-        Don't clutter up the output yakking about all the dross in the
-        DEV web root (unless the user has asked for everything).
+        Unless the user has asked for everything, we skip the files
+        and directories whose names match the patterns in the
+        `diff.excludes` file (as with the -X option for `diff`).
         """
 
         if self.opts.all:
-            return output
-        pattern = r"only in d:[\\/]inetpub[\\/]wwwroot: [^\n]*\n"
-        output = re.sub(pattern, "", output, flags=re.IGNORECASE)
-        return output
+            return []
+        with open(self.EXCLUDES, encoding="utf-8") as fp:
+            return [line.strip() for line in fp if line.strip()]
+
+    def load_manifest(self):
+        """
+        Fetch the checksums recorded by the build script, if present.
+        """
+
+        path = os.path.join(self.opts.build, self.MANIFEST)
+        if not os.path.isfile(path):
+            return {}
+        with open(path, encoding="utf-8") as fp:
+            return json.load(fp)["directories"]
 
     def fetch_options(self):
         """
@@ -127,13 +128,18 @@ class Control:
         parser.add_argument("--all", "-a", action="store_true",
                             help="also report expected differences")
         parser.add_argument("--reverse", "-r", action="store_true",
-                            help="put new release set on left side of diff")
+                            help="put live file system on left side of diff")
+        parser.add_argument("--jobs", "-j", type=int, default=4,
+                            help="number of directories to compare at once")
         group = parser.add_mutually_exclusive_group()
         group.add_argument("--context", "-c", action="store_true",
                            help="output three lines of context on each side")
         group.add_argument("--unified", "-u", action="store_true",
                            help="generate a unified context diff")
-        return parser.parse_args()
+        opts = parser.parse_args()
+        if opts.jobs < 1:
+            parser.error("--jobs must be at least 1")
+        return opts
 
     @staticmethod
     def find_cdr_drive():
@@ -147,6 +153,371 @@ class Control:
         return None
 
 
+class Comparison:
+    """
+    Comparison of one top-level directory of the build with the live copy.
+
+    Class values:
+      BLOCK_SIZE - number of bytes to read at a time when hashing
+      CONTEXT - number of lines of context for context/unified diffs
+
+    Attributes:
+      control - access to the runtime options, excludes, and manifest
+      name - name of the top-level directory in the build set
+      source - path to the directory in the build set
+      target - path to the live directory
+      lines - sequence of strings for the report
+    """
+
+    BLOCK_SIZE = 1024 * 1024
+    CONTEXT = 3
+
+    def __init__(self, control, name, source, target):
+        """
+        Capture the caller's values.
+        """
+
+        self.control = control
+        self.name = name
+        self.source = source
+        self.target = target
+        self.lines = []
+
+    def run(self):
+        """
+        Walk the two trees and return the report of their differences.
+
+        If the directory isn't on the live system at all, say so.
+        """
+
+        if os.path.isdir(self.target):
+            self.compare_dirs(self.source, self.target)
+        else:
+            self.only_in(os.path.dirname(self.source), self.name, live=False)
+        return "".join(self.lines)
+
+    @property
+    def opts(self):
+        """
+        Runtime control settings.
+        """
+
+        return self.control.opts
+
+    @property
+    def ignoring(self):
+        """
+        True if differences in case or white space are to be ignored.
+        """
+
+        opts = self.opts
+        if opts.ignore_case or opts.ignore_space_change:
+            return True
+        return opts.ignore_all_space
+
+    def compare_dirs(self, source, target):
+        """
+        Compare two directories recursively.
+
+        Pass:
+          source - path to a directory in the build set
+          target - path to the corresponding live directory
+        """
+
+        old = self.scan(source)
+        new = self.scan(target)
+        for key in sorted(set(old) | set(new)):
+            if key not in new:
+                self.only_in(source, old[key].name, live=False)
+            elif key not in old:
+                self.only_in(target, new[key].name, live=True)
+            else:
+                a, b = old[key], new[key]
+                a_path = f"{source}/{a.name}"
+                b_path = f"{target}/{b.name}"
+                if a.is_dir() and b.is_dir():
+                    self.compare_dirs(a_path, b_path)
+                elif a.is_dir() or b.is_dir():
+                    a_type = "directory" if a.is_dir() else "regular file"
+                    b_type = "directory" if b.is_dir() else "regular file"
+                    left, right = self.sides(a_path, b_path)
+                    if self.opts.reverse:
+                        a_type, b_type = b_type, a_type
+                    args = left, a_type, right, b_type
+                    self.lines.append("File %s is a %s while file %s is a %s\n"
+                                      % args)
+                else:
+                    self.compare_files(a, b, a_path, b_path)
+
+    def scan(self, path):
+        """
+        Find the entries in a directory which we aren't told to skip.
+
+        The keys for the returned dictionary are normalized for the
+        platform, so names which differ only by case are matched up
+        on Windows.
+
+        Return:
+          dictionary of `os.DirEntry` objects indexed by normalized name
+        """
+
+        entries = {}
+        with os.scandir(path) as scanner:
+            for entry in scanner:
+                if not self.excluded(entry.name):
+                    entries[os.path.normcase(entry.name)] = entry
+        return entries
+
+    def excluded(self, name):
+        """
+        Determine whether a file or directory is to be skipped.
+        """
+
+        for pattern in self.control.excludes:
+            if fnmatch.fnmatch(name, pattern):
+                return True
+        return False
+
+    def only_in(self, directory, name, live):
+        """
+        Report a file or directory which only exists on one side.
+
+        Don't clutter up the output yakking about all the dross in the
+        DEV web root (unless the user has asked for everything).
+
+        Pass:
+          directory - path of the directory holding the entry
+          name - name of the file or subdirectory
+          live - True if the entry is only on the live file system
+        """
+
+        if live and not self.opts.all:
+            wwwroot = self.control.drive + ":/Inetpub/wwwroot"
+            if directory.lower() == wwwroot.lower():
+                return
+        self.lines.append(f"Only in {directory}: {name}\n")
+
+    def sides(self, source, target):
+        """
+        Put the paths in the order in which they are to be reported.
+
+        By default, the build set is on the left.
+        """
+
+        if self.opts.reverse:
+            return target, source
+        return source, target
+
+    def compare_files(self, a, b, a_path, b_path):
+        """
+        Compare two files and report any differences.
+
+        We start with the cheapest checks, and only read the files
+        if we have to. Different sizes are only conclusive if we're
+        not ignoring anything. If the checksums match, the files are
+        identical. If they don't, we have to look at the content.
+
+        Pass:
+          a - `os.DirEntry` object for the file in the build set
+          b - `os.DirEntry` object for the live file
+          a_path - path to the file in the build set
+          b_path - path to the live file
+        """
+
+        size = a.stat().st_size
+        if size == b.stat().st_size:
+            if self.build_digest(a_path, size) == self.digest(b_path):
+                return
+        elif not self.ignoring and self.opts.brief:
+            self.report_files_differ(a_path, b_path)
+            return
+        with open(a_path, "rb") as fp:
+            a_bytes = fp.read()
+        with open(b_path, "rb") as fp:
+            b_bytes = fp.read()
+        if a_bytes == b_bytes:
+            return
+        if b"\0" in a_bytes[:8192] or b"\0" in b_bytes[:8192]:
+            left, right = self.sides(a_path, b_path)
+            self.lines.append(f"Binary files {left} and {right} differ\n")
+            return
+        a_lines = a_bytes.decode("utf-8", errors="replace").splitlines(True)
+        b_lines = b_bytes.decode("utf-8", errors="replace").splitlines(True)
+        a_keys = [self.normalize(line) for line in a_lines]
+        b_keys = [self.normalize(line) for line in b_lines]
+        if a_keys == b_keys:
+            return
+        if self.opts.brief:
+            self.report_files_differ(a_path, b_path)
+            return
+        if self.opts.reverse:
+            a_path, b_path = b_path, a_path
+            a_lines, b_lines = b_lines, a_lines
+            a_keys, b_keys = b_keys, a_keys
+        self.lines.append(f"diff -r {a_path} {b_path}\n")
+        matcher = SequenceMatcher(None, a_keys, b_keys, autojunk=False)
+        if self.opts.unified:
+            self.unified(matcher, a_lines, b_lines, a_path, b_path)
+        elif self.opts.context:
+            self.context(matcher, a_lines, b_lines, a_path, b_path)
+        else:
+            self.normal(matcher, a_lines, b_lines)
+
+    def report_files_differ(self, a_path, b_path):
+        """
+        Add the brief report of a difference between two files.
+        """
+
+        left, right = self.sides(a_path, b_path)
+        self.lines.append(f"Files {left} and {right} differ\n")
+
+    def build_digest(self, path, size):
+        """
+        Get the checksum for a file in the build set.
+
+        Use the checksum from the build's manifest if we have it.
+        """
+
+        top = f"{self.source}/"
+        relpath = path[len(top):] if path.startswith(top) else None
+        info = self.control.manifest.get(self.name, {}).get(relpath)
+        if info and info.get("size") == size:
+            return info.get("sha256")
+        return self.digest(path)
+
+    @classmethod
+    def digest(cls, path):
+        """
+        Calculate the SHA-256 checksum for a file's content.
+        """
+
+        sha256 = hashlib.sha256()
+        with open(path, "rb") as fp:
+            block = fp.read(cls.BLOCK_SIZE)
+            while block:
+                sha256.update(block)
+                block = fp.read(cls.BLOCK_SIZE)
+        return sha256.hexdigest()
+
+    def normalize(self, line):
+        """
+        Prepare a line for comparison, dropping differences we ignore.
+        """
+
+        if self.opts.ignore_all_space:
+            line = re.sub(r"\s+", "", line)
+        elif self.opts.ignore_space_change:
+            line = re.sub(r"\s+", " ", line).rstrip()
+        if self.opts.ignore_case:
+            line = line.lower()
+        return line
+
+    def normal(self, matcher, a, b):
+        """
+        Report the differences using diff's default format.
+        """
+
+        def lines(start, stop):
+            if stop - start == 1:
+                return str(start + 1)
+            return f"{start + 1},{stop}"
+        for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+            if tag == "equal":
+                continue
+            if tag == "delete":
+                self.lines.append(f"{lines(i1, i2)}d{j1}\n")
+            elif tag == "insert":
+                self.lines.append(f"{i1}a{lines(j1, j2)}\n")
+            else:
+                self.lines.append(f"{lines(i1, i2)}c{lines(j1, j2)}\n")
+            for line in a[i1:i2]:
+                self.add_line("< ", line)
+            if tag == "replace":
+                self.lines.append("---\n")
+            for line in b[j1:j2]:
+                self.add_line("> ", line)
+
+    def unified(self, matcher, a, b, a_path, b_path):
+        """
+        Report the differences using the unified context format.
+        """
+
+        def lines(start, stop):
+            length = stop - start
+            if length == 1:
+                return str(start + 1)
+            return f"{start + 1 if length else start},{length}"
+        self.lines.append(f"--- {a_path}\t{self.stamp(a_path)}\n")
+        self.lines.append(f"+++ {b_path}\t{self.stamp(b_path)}\n")
+        for group in matcher.get_grouped_opcodes(self.CONTEXT):
+            first, last = group[0], group[-1]
+            a_range = lines(first[1], last[2])
+            b_range = lines(first[3], last[4])
+            self.lines.append(f"@@ -{a_range} +{b_range} @@\n")
+            for tag, i1, i2, j1, j2 in group:
+                if tag == "equal":
+                    for line in a[i1:i2]:
+                        self.add_line(" ", line)
+                    continue
+                for line in a[i1:i2]:
+                    self.add_line("-", line)
+                for line in b[j1:j2]:
+                    self.add_line("+", line)
+
+    def context(self, matcher, a, b, a_path, b_path):
+        """
+        Report the differences using the context format.
+        """
+
+        def lines(start, stop):
+            length = stop - start
+            if not length:
+                return str(start)
+            if length == 1:
+                return str(start + 1)
+            return f"{start + 1},{stop}"
+        prefix = dict(insert="+ ", delete="- ", replace="! ", equal="  ")
+        self.lines.append(f"*** {a_path}\t{self.stamp(a_path)}\n")
+        self.lines.append(f"--- {b_path}\t{self.stamp(b_path)}\n")
+        for group in matcher.get_grouped_opcodes(self.CONTEXT):
+            first, last = group[0], group[-1]
+            self.lines.append("***************\n")
+            self.lines.append(f"*** {lines(first[1], last[2])} ****\n")
+            if any(tag in ("replace", "delete") for tag, *_ in group):
+                for tag, i1, i2, _, _ in group:
+                    if tag != "insert":
+                        for line in a[i1:i2]:
+                            self.add_line(prefix[tag], line)
+            self.lines.append(f"--- {lines(first[3], last[4])} ----\n")
+            if any(tag in ("replace", "insert") for tag, *_ in group):
+                for tag, _, _, j1, j2 in group:
+                    if tag != "delete":
+                        for line in b[j1:j2]:
+                            self.add_line(prefix[tag], line)
+
+    def add_line(self, prefix, line):
+        """
+        Add a line from one of the files to the report.
+
+        The line endings are normalized, and we flag the last line
+        of a file if it has no line ending (as `diff` does).
+        """
+
+        self.lines.append(prefix + line.rstrip("\r\n") + "\n")
+        if not line.endswith("\n"):
+            self.lines.append("\\ No newline at end of file\n")
+
+    @staticmethod
+    def stamp(path):
+        """
+        Format a file's modification time for a context diff header.
+        """
+
+        mtime = os.path.getmtime(path)
+        stamp = datetime.datetime.fromtimestamp(mtime)
+        return stamp.strftime("%Y-%m-%d %H:%M:%S.%f")
+
+
 if __name__ == "__main__":
     "Top-level entry point."
     Control().run()
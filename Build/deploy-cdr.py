@@ -16,12 +16,17 @@ JIRA::OCECDR-4300 - rewrite for Jenkins/GitHub (Bob Kline, September 2017)
 """
 
 import argparse
+import datetime
+import hashlib
+import json
 import logging
 import os
 import shutil
 import subprocess
 import sys
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 
 class Control:
@@ -30,6 +35,7 @@ class Control:
 
     Class values:
       SERVICES - things we need to suspend in order to replace the files
+      MANIFEST - name of the file listing the checksums for the build
       POPEN_OPTS - options for launching a sub process
 
     Attributes:
@@ -38,9 +44,16 @@ class Control:
       drive - letter representing the disk volume for the CDR
       opts - runtime control settings
       logger - object for recording what we do
+      started - when the deployment began
+      outage - when the services were stopped (None if they weren't)
+      timings - sequence of records for the processing phases
+      lock - serializes access to the timing records across threads
+      manifest - checksums for the build set's files, indexed by
+                 directory name and relative path (if available)
     """
 
     SERVICES = "CDRScheduler", "W3SVC"
+    MANIFEST = "MANIFEST.json"
     POPEN_OPTS = dict(
         shell=True,
         stdout=subprocess.PIPE,
@@ -54,32 +67,194 @@ class Control:
         Fetching the tier also sets self.drive as a side effect.
         """
 
+        self.started = datetime.datetime.now()
+        self.outage = None
+        self.timings = []
+        self.lock = threading.Lock()
         self.dirs = self.Directory.all_dirs()
         self.tier = self.get_tier()
         self.opts = self.fetch_options()
         self.logger = self.make_logger()
+        self.manifest = self.load_manifest()
 
     def run(self):
         """
         Install the directories present in the build.
 
         If we running in live mode, we suspend the CDR services while
-        we work.
+        we work. If any of the directories could not be installed,
+        we leave the services stopped, so that the operator can
+        decide whether it is safe to start them again.
+
+        With the --stage option, the new trees are assembled next to
+        the live ones while the services are still running, and the
+        services are only stopped long enough to swap the directories.
+        If a swap fails and all of the directories could be put back
+        the way they were, the services are started again, because
+        the old release is still intact.
+
+        Whether we succeed or not, we leave behind a report of how
+        long each phase of the processing took.
         """
 
-        self.stop_services()
-        for path, dirs, files in os.walk(self.opts.source):
-            while dirs:
-                name = dirs.pop(0)
+        try:
+            directories = self.find_directories()
+            if self.opts.stage:
+                self.report(self.install(directories, "stage", "staged"))
+                self.stop_services()
+                errors, restored = self.swap(directories)
+                if errors and restored and not self.opts.test:
+                    self.logger.info("swap rolled back; restarting services")
+                    self.start_services()
+                self.report(errors)
+            else:
+                self.stop_services()
+                self.report(self.install(directories))
+            if not self.opts.test:
+                self.start_services()
+            self.logger.info("deployment complete")
+        finally:
+            self.save_timings()
+
+    def find_directories(self):
+        """
+        Find the directories in the build set which we know how to deploy.
+
+        We only look at the top level of the build set.
+
+        Return:
+          sequence of `Directory` objects
+        """
+
+        directories = []
+        for name in sorted(os.listdir(self.opts.source)):
+            if os.path.isdir(os.path.join(self.opts.source, name)):
                 directory = self.dirs.get(name.lower())
                 if directory:
-                    directory.install(self)
-                    self.logger.info("installed %s", directory.name)
+                    directories.append(directory)
                 elif name.lower() != "emailers":
                     self.logger.warning("%s not supported", name)
-        if not self.opts.test:
-            self.start_services()
-        self.logger.info("deployment complete")
+        return directories
+
+    def install(self, directories, action="install", done="installed"):
+        """
+        Install (or stage) the directories, several at a time if requested.
+
+        The trees are independent of each other, with one exception:
+        the web server tree supplies the tier's icon which is copied
+        into the ClientFiles directory. So we hold back the Inetpub
+        directory until everything else has been installed.
+
+        Pass:
+          directories - sequence of `Directory` objects to be installed
+          action - name of the `Directory` method to invoke
+          done - verb used to log successful processing of a directory
+
+        Return:
+          dictionary of error messages indexed by directory name
+        """
+
+        errors = {}
+        deferred = [d for d in directories if d.name == "Inetpub"]
+        directories = [d for d in directories if d.name != "Inetpub"]
+        args = action, done
+        with ThreadPoolExecutor(max_workers=self.opts.jobs) as executor:
+            futures = {}
+            for directory in directories:
+                future = executor.submit(self.process, directory, *args)
+                futures[future] = directory
+            for future in as_completed(futures):
+                error = future.result()
+                if error:
+                    errors[futures[future].name] = error
+        for directory in deferred:
+            error = self.process(directory, *args)
+            if error:
+                errors[directory.name] = error
+        return errors
+
+    def process(self, directory, action, done):
+        """
+        Install (or stage) a single directory, catching any failures.
+
+        Pass:
+          directory - `Directory` object to be processed
+          action - name of the `Directory` method to invoke
+          done - verb used to log successful processing of the directory
+
+        Return:
+          string describing the failure, or None if successful
+        """
+
+        started = time.time()
+        try:
+            getattr(directory, action)(self)
+        except Exception as e:
+            self.logger.exception("failure processing %s", directory.name)
+            return str(e) or repr(e)
+        finally:
+            self.record(action, directory.name, time.time() - started)
+        self.logger.info("%s %s", done, directory.name)
+        return None
+
+    def swap(self, directories):
+        """
+        Replace the live directories with the staged trees.
+
+        This is done with the services stopped, and only involves
+        renaming directories, so it should take very little time.
+        If any of the swaps fails, we put back the directories we
+        have already swapped, so the system is left as it was.
+
+        Pass:
+          directories - sequence of staged `Directory` objects
+
+        Return:
+          dictionary of error messages indexed by directory name
+          flag which is True if every directory is as it was before
+          the swapping began (or if there were no failures)
+        """
+
+        swapped = []
+        for directory in directories:
+            started = time.time()
+            try:
+                directory.swap(self)
+                self.record("swap", directory.name, time.time() - started)
+                swapped.append(directory)
+            except Exception as e:
+                self.logger.exception("failure swapping %s", directory.name)
+                errors = {directory.name: str(e) or repr(e)}
+
+                # `Directory.swap()` puts back its own live directory if
+                # it can, so that directory is only still set aside under
+                # the PREVIOUS name (which `stage()` cleared) if it couldn't.
+                previous = directory.get_target(self) + directory.PREVIOUS
+                restored = not os.path.exists(previous)
+                for other in reversed(swapped):
+                    try:
+                        other.unswap(self)
+                    except Exception as e:
+                        self.logger.exception("failure restoring %s",
+                                              other.name)
+                        errors[other.name] = f"not restored: {e}"
+                        restored = False
+                return errors, restored
+        return {}, True
+
+    def report(self, errors):
+        """
+        Log any failures and bail out if there were any.
+
+        Pass:
+          errors - dictionary of error messages indexed by directory name
+        """
+
+        if errors:
+            for name in sorted(errors):
+                self.logger.error("%s not installed: %s", name, errors[name])
+            self.logger.error("deployment failed")
+            sys.exit(1)
 
     def stop_services(self):
         """
@@ -88,8 +263,8 @@ class Control:
         As a side effect, create a test destination directory if
         appropriate.
 
-        Pause for a few seconds after stopping the services to let
-        the dust settle.
+        We don't return until the service manager reports that each
+        service has actually stopped.
         """
 
         if self.opts.test:
@@ -99,13 +274,17 @@ class Control:
                 self.logger.info("created %s", self.opts.test)
         else:
             self.logger.info("stopping services")
+            self.outage = time.time()
             self.services = [self.Service(s, self) for s in self.SERVICES]
             for service in reversed(self.services):
                 if not service.running():
                     self.logger.warning("%s already stopped", service.name)
                 else:
                     service.stop()
-            time.sleep(5)
+                    elapsed = service.elapsed["stop"]
+                    args = service.name, elapsed
+                    self.logger.info("stopped %s in %.1f seconds", *args)
+                    self.record("stop service", service.name, elapsed)
 
     def start_services(self):
         """
@@ -127,7 +306,10 @@ class Control:
         for service in self.services:
             if service.name.upper() != "CDR":
                 service.start()
-                self.logger.info("started %s service", service.name)
+                elapsed = service.elapsed["start"]
+                args = service.name, elapsed
+                self.logger.info("started %s service in %.1f seconds", *args)
+                self.record("start service", service.name, elapsed)
 
     def fetch_options(self):
         """
@@ -140,10 +322,30 @@ class Control:
         parser.add_argument("source", help="location of deployment files")
         parser.add_argument("-t", "--test", metavar="DESTINATION",
                             help="write here instead of live CDR system")
-        parser.add_argument("-o", "--overlay", action="store_true",
-                            help="don't remove existing files/directories")
+        group = parser.add_mutually_exclusive_group()
+        group.add_argument("-o", "--overlay", action="store_true",
+                           help="don't remove existing files/directories")
+        group.add_argument("-i", "--incremental", action="store_true",
+                           help="only copy new/changed files, drop old ones")
         parser.add_argument("-l", "--logpath", default=logpath)
-        return parser.parse_args()
+        parser.add_argument("-j", "--jobs", type=int, default=1,
+                            help="number of directories to install at once")
+        parser.add_argument("-w", "--wait", type=float, default=120,
+                            help="seconds to wait for a service to start "
+                            "or stop")
+        parser.add_argument("-b", "--buffer", type=int, default=1024,
+                            metavar="KB", help="file copy buffer size")
+        parser.add_argument("-s", "--stage", action="store_true",
+                            help="prepare new directories before stopping "
+                            "services, then swap them in")
+        opts = parser.parse_args()
+        if opts.jobs < 1:
+            parser.error("--jobs must be at least 1")
+        if opts.buffer < 1:
+            parser.error("--buffer must be at least 1")
+        if opts.wait <= 0:
+            parser.error("--wait must be a positive number of seconds")
+        return opts
 
     def make_logger(self):
         """
@@ -178,10 +380,67 @@ class Control:
         Log any problems as warnings but don't abort processing.
         """
 
+        started = time.time()
         args = self.drive + r":\cdr\Bin\fix-permissions.cmd", target
         result = self.execute(args)
         if result.code:
             self.logger.warning("%s: %s", target, result.output)
+        self.record("fix permissions", target, time.time() - started)
+
+    def record(self, phase, item, elapsed, files=None, size=None):
+        """
+        Remember how long a piece of the deployment took.
+
+        This can be called from multiple threads at the same time.
+
+        Pass:
+          phase - string identifying the type of processing
+          item - name of the directory (or service) processed
+          elapsed - number of seconds the processing took
+          files - optional number of files processed
+          size - optional number of bytes processed
+        """
+
+        timing = dict(
+            phase=phase,
+            item=item.replace("\\", "/"),
+            seconds=round(elapsed, 3),
+            files=files,
+            bytes=size,
+        )
+        with self.lock:
+            self.timings.append(timing)
+
+    def save_timings(self):
+        """
+        Write the JSON timing report in the same directory as the log.
+
+        The name of the report includes the time the deployment began,
+        so the reports for earlier deployments are preserved for
+        comparison.
+        """
+
+        stamp = self.started.strftime("%Y%m%d%H%M%S")
+        directory = os.path.dirname(os.path.abspath(self.opts.logpath))
+        path = os.path.join(directory, f"deploy-{stamp}.json")
+        now = datetime.datetime.now()
+        outage = None
+        if self.outage is not None:
+            outage = round(time.time() - self.outage, 3)
+        report = dict(
+            tier=self.tier,
+            source=self.opts.source.replace("\\", "/"),
+            started=str(self.started),
+            seconds=round((now - self.started).total_seconds(), 3),
+            outage=outage,
+            phases=self.timings,
+        )
+        try:
+            with open(path, "w", encoding="utf-8") as fp:
+                json.dump(report, fp, indent=2)
+            self.logger.info("timing report in %s", path.replace("\\", "/"))
+        except Exception:
+            self.logger.exception("failure writing %s", path)
 
     @classmethod
     def execute(cls, args):
@@ -198,6 +457,27 @@ class Control:
                 self.output = output
         return Result(p.returncode, output)
 
+    def load_manifest(self):
+        """
+        Fetch the checksums recorded by the build script.
+
+        Older build sets won't have a manifest, and we can get along
+        without it by calculating the checksums ourselves.
+
+        Return:
+          dictionary of checksum information indexed by directory name
+        """
+
+        path = os.path.join(self.opts.source, self.MANIFEST)
+        if not os.path.isfile(path):
+            return {}
+        try:
+            with open(path, encoding="utf-8") as fp:
+                return json.load(fp)["directories"]
+        except Exception:
+            self.logger.exception("unable to load %s", path)
+            return {}
+
     def get_tier(self):
         """
         Figure out which CDR tier we're running on.
@@ -226,11 +506,21 @@ class Control:
         the files in a location other than where the live CDR
         runs from.
 
+        Class values:
+          FIRST_POLL - seconds to wait before checking the service again
+          MAX_POLL - upper limit for the growing interval between checks
+
         Attributes:
           name - internal name for the service (not the display name)
           nssm - path to the service manager program
+          timeout - how long to wait for the service to start or stop
+          elapsed - seconds taken to reach the requested state, indexed
+                    by "start" or "stop"
         """
 
+        FIRST_POLL = 0.25
+        MAX_POLL = 5
+
         def __init__(self, name, control):
             """
             Save the internal name of the service and the NSSM path.
@@ -239,6 +529,8 @@ class Control:
             self.name = name
             self.logger = control.logger
             self.nssm = control.drive + r":\cdr\Bin\nssm.exe"
+            self.timeout = control.opts.wait
+            self.elapsed = dict(start=0.0, stop=0.0)
 
         def control(self, option):
             """
@@ -269,29 +561,68 @@ class Control:
 
             return "SERVICE_RUNNING" in self.control("status")
 
+        def stopped(self):
+            """
+            Ask the service manager whether the service is fully stopped.
+            """
+
+            return "SERVICE_STOPPED" in self.control("status")
+
+        def wait(self, ready, state, started):
+            """
+            Poll the service manager until the service reaches a state.
+
+            We start out checking frequently, doubling the interval
+            between checks (up to a limit) until the service is ready.
+            If the service doesn't get there in time, log the problem
+            and exit.
+
+            Pass:
+              ready - method which returns True when we're done waiting
+              state - "start" or "stop" (for logging and timing)
+              started - when the NET command was invoked
+
+            Return:
+              number of seconds elapsed since `started`
+            """
+
+            delay = self.FIRST_POLL
+            while not ready():
+                elapsed = time.time() - started
+                if elapsed >= self.timeout:
+                    args = self.name, state, self.timeout
+                    self.logger.error("%s did not %s in %s seconds", *args)
+                    sys.exit(1)
+                time.sleep(min(delay, self.timeout - elapsed))
+                delay = min(delay * 2, self.MAX_POLL)
+            return time.time() - started
+
         def start(self):
             """
-            Start the service and pause before continuing.
+            Start the service and wait until it is running.
 
             Had problems with `self.control("start")` running into
             unexpected 'PENDING' output, so switched to NET START ....
             """
 
             if not self.running():
+                started = time.time()
                 args = "NET", "START", self.name
                 result = Control.execute(args)
                 if result.code:
                     command = " ".join(args)
                     self.logger.error("%s: %s", command, result.output)
                     sys.exit(1)
-                time.sleep(2)
+                self.elapsed["start"] = self.wait(self.running, "start",
+                                                  started)
 
         def stop(self):
             """
-            Ask the service manager to stop the service.
+            Ask the service manager to stop the service and wait for it.
             """
 
             if self.running():
+                started = time.time()
                 args = "NET", "STOP", self.name
                 result = Control.execute(args)
                 if result.code:
@@ -301,7 +632,8 @@ class Control:
                 if self.name.upper() == "CDR":
                     args = r"d:\cdr\bin\ShutdownCdr.exe", "bkline", ""
                     Control.execute(args)
-                time.sleep(2)
+                self.elapsed["stop"] = self.wait(self.stopped, "stop",
+                                                 started)
 
     class Directory:
         """
@@ -310,30 +642,157 @@ class Control:
         Class values:
           WWW_CLEAN - web server directories to be replaced completely
                       (unless the --overlay option is set)
+          BLOCK_SIZE - number of bytes to read at a time when hashing
+          STAGED - suffix for a new tree waiting to be swapped in
+          PREVIOUS - suffix for the tree replaced by the last swap
 
         Attributes:
           name - the name of the directory to be deployed
         """
 
         WWW_CLEAN = "cgi-bin", "images", "js", "stylesheets"
+        BLOCK_SIZE = 1024 * 1024
+        STAGED = ".new"
+        PREVIOUS = ".prev"
 
         def __init__(self, name):
             "Save the directory name."
             self.name = name
 
-        def install(self, control):
+        def install(self, control, target=None):
             """
             Route the web server's files to special handling.
 
             Everything else is pretty much a straight copy.
+
+            Pass:
+              control - access to runtime options and logging
+              target - optional override for the installation location
             """
 
+            if target is None:
+                target = self.get_target(control)
             if self.name == "Inetpub":
-                self.install_inetpub_files(control)
+                self.install_inetpub_files(control, target)
             else:
-                self.install_directory(control)
+                self.install_directory(control, target)
+
+        def get_target(self, control):
+            r"""
+            Find out where this directory gets installed.
+
+            All of the directories are installed under \cdr, except
+            for the web server files.
+
+            Pass:
+              control - access to runtime options and the CDR drive
+
+            Return:
+              path to the live (or test) location for the directory
+            """
+
+            if self.name == "Inetpub":
+                if control.opts.test:
+                    return os.path.join(control.opts.test, "Inetpub",
+                                        "wwwroot")
+                return os.path.join(control.drive + r":\Inetpub", "wwwroot")
+            if control.opts.test:
+                return os.path.join(control.opts.test, "cdr", self.name)
+            return os.path.join(control.drive + r":\cdr", self.name)
+
+        def stage(self, control):
+            """
+            Assemble the new tree next to the live directory.
+
+            This is done while the services are still running. The
+            tree left by the previous staged deployment is discarded
+            at this point, so it remains available for rolling back
+            until the next deployment. If we are to preserve (or
+            compare against) what is already installed, the staged
+            tree starts out as a copy of the live directory.
+
+            Pass:
+              control - access to runtime options and logging
+            """
+
+            target = self.get_target(control)
+            staged = target + self.STAGED
+            self.remove(control, staged)
+            self.remove(control, target + self.PREVIOUS)
+            if os.path.exists(target):
+                opts = control.opts
+                if self.name == "Inetpub" or opts.overlay or opts.incremental:
+                    self.copy(control, target, staged)
+            self.install(control, staged)
+
+        def swap(self, control):
+            """
+            Replace the live directory with the staged tree.
+
+            The replaced directory is kept under a separate name, so
+            a deployment can be rolled back by renaming directories.
+
+            Pass:
+              control - access to runtime options and logging
+            """
+
+            target = self.get_target(control)
+            previous = target + self.PREVIOUS
+            if os.path.exists(target):
+                os.rename(target, previous)
+            try:
+                os.rename(target + self.STAGED, target)
+            except Exception:
+                if os.path.exists(previous):
+                    os.rename(previous, target)
+                raise
+            control.logger.info("swapped in %s", target.replace("\\", "/"))
+
+        def unswap(self, control):
+            """
+            Put back the directory replaced by `swap()`.
+
+            Pass:
+              control - access to runtime options and logging
+            """
+
+            target = self.get_target(control)
+            previous = target + self.PREVIOUS
+            os.rename(target, target + self.STAGED)
+            if os.path.exists(previous):
+                os.rename(previous, target)
+            control.logger.info("restored %s", target.replace("\\", "/"))
 
-        def install_directory(self, control):
+        @staticmethod
+        def remove(control, path):
+            """
+            Drop a directory, making sure it's really gone.
+
+            Note: we discovered when deploying Ising to QA that
+            Windows didn't really do what it was asked all the
+            time by the `shutil.rmtree()` call. Hence the more
+            robust loop which checks to make sure the old files
+            and directories are gone before proceeding.
+
+            Pass:
+              control - access to logging
+              path - location of the directory to be removed
+            """
+
+            tries = 10
+            pattern = "removing %s (%d tries left)"
+            started = time.time()
+            while os.path.exists(path):
+                if not tries:
+                    raise Exception("can't remove {!r}".format(path))
+                control.logger.info(pattern, path, tries)
+                shutil.rmtree(path)
+                tries -= 1
+                time.sleep(2)
+            if tries < 10:
+                control.record("remove", path, time.time() - started)
+
+        def install_directory(self, control, target):
             """
             Copy the files from the build set.
 
@@ -344,33 +803,26 @@ class Control:
             or subdirectories which were present in the target
             location but not in the build set.
 
-            Note: we discovered when deploying Ising to QA that
-            Windows didn't really do what it was asked all the
-            time by the `shutil.rmtree()` call. Hence the more
-            robust loop which checks to make sure the old files
-            and directories are gone before proceeding.
+            The --incremental option avoids both of those approaches,
+            comparing the two trees and only touching the files which
+            have been added, changed, or removed in the build set.
+
+            Pass:
+              control - access to runtime options and logging
+              target - location where the directory is installed
             """
 
             source = os.path.join(control.opts.source, self.name)
-            target = os.path.join(control.drive + r":\cdr", self.name)
-            if control.opts.test:
-                target = os.path.join(control.opts.test, "cdr", self.name)
-            if control.opts.overlay and os.path.exists(target):
-                self.copy(source, target)
+            if control.opts.incremental and os.path.exists(target):
+                self.sync(control, source, target)
+            elif control.opts.overlay and os.path.exists(target):
+                self.copy(control, source, target, skip_unchanged=True)
             else:
-                tries = 10
-                pattern = "removing %s (%d tries left)"
-                while os.path.exists(target):
-                    if not tries:
-                        raise Exception("can't remove {!r}".format(target))
-                    control.logger.info(pattern, target, tries)
-                    shutil.rmtree(target)
-                    tries -= 1
-                    time.sleep(2)
-                shutil.copytree(source, target)
+                self.remove(control, target)
+                self.copy(control, source, target)
             control.fix_permissions(target)
 
-        def install_inetpub_files(self, control):
+        def install_inetpub_files(self, control, target):
             r"""
             Replace the Inetpub/wwwroot tree.
 
@@ -379,49 +831,315 @@ class Control:
              2. some files differ from tier to tier (e.g. the favicon)
              3. all the other directories are installed under \cdr
                 except this one.
+
+            With the --incremental option, only the WWW_CLEAN directories
+            have files which are missing from the build set removed.
+
+            If ClientFiles has been staged, the tier's icon is copied
+            into the staged tree instead of the live one (or the test
+            location, for a test run).
+
+            Pass:
+              control - access to runtime options and logging
+              target - location where the web server files are installed
             """
 
             source = os.path.join(control.opts.source, "Inetpub", "wwwroot")
-            target = os.path.join(control.drive + r":\Inetpub", "wwwroot")
-            if control.opts.test:
-                target = os.path.join(control.opts.test, "Inetpub", "wwwroot")
             if not os.path.exists(target):
-                shutil.copytree(source, target)
+                self.copy(control, source, target)
+            elif control.opts.incremental:
+                for name in os.listdir(source):
+                    path = os.path.join(source, name)
+                    destination = os.path.join(target, name)
+                    if name in self.WWW_CLEAN and os.path.isdir(path):
+                        self.sync(control, path, destination)
+                    elif os.path.isdir(path):
+                        self.sync(control, path, destination, prune=False)
+                    elif self.differ(control, path, destination):
+                        self.copy_file(control, path, destination)
             else:
                 if not control.opts.overlay:
                     for name in self.WWW_CLEAN:
                         path = os.path.join(target, name)
                         if os.path.exists(path):
                             shutil.rmtree(path)
-                self.copy(source, target)
+                overlay = control.opts.overlay
+                self.copy(control, source, target, skip_unchanged=overlay)
             if control.tier:
+                started = time.time()
                 favicon = os.path.join(target, "favicon.ico")
                 tiericon = os.path.join(target, f"favicon-{control.tier}.ico")
                 shutil.copy(tiericon, favicon)
-                shutil.copy(tiericon,
-                            control.drive + r":\cdr\ClientFiles\cdr.ico")
+                client_files = control.dirs["clientfiles"].get_target(control)
+                staged = client_files + self.STAGED
+                if control.opts.stage and os.path.isdir(staged):
+                    client_files = staged
+                if os.path.isdir(client_files):
+                    icon = os.path.join(client_files, "cdr.ico")
+                    shutil.copy(tiericon, icon)
+                elapsed = time.time() - started
+                control.record("favicon", target, elapsed, 1)
             control.fix_permissions(target)
 
-        def copy(self, what, where):
+        def copy(self, control, what, where, skip_unchanged=False):
             """
             Recursively copy a directory.
 
             We can't use `shutil.copytree()` when the target directory
             already exists, because that function requires that the
             destination does not already exist. So we implement our
-            own logic.
+            own logic, walking the tree with `os.scandir()` (which
+            gives us the file sizes and timestamps without extra
+            system calls) instead of recursing for each directory.
+
+            Pass:
+              control - access to runtime options and logging
+              what - path to the directory being copied
+              where - path to the destination directory
+              skip_unchanged - if True, don't copy a file whose size
+                               and modification time match those of
+                               the file already in the destination
+
+            Return:
+              tuple of the number of files and bytes copied
             """
 
-            if os.path.isdir(what):
-                if not os.path.isdir(where):
-                    os.makedirs(where)
-                files = os.listdir(what)
-                for f in files:
-                    source = os.path.join(what, f)
-                    destination = os.path.join(where, f)
-                    self.copy(source, destination)
-            else:
-                shutil.copyfile(what, where)
+            started = time.time()
+            files = size = skipped = 0
+            pending = [(what, where)]
+            while pending:
+                source, target = pending.pop()
+                if not os.path.isdir(target):
+                    os.makedirs(target)
+                with os.scandir(source) as entries:
+                    for entry in entries:
+                        destination = os.path.join(target, entry.name)
+                        if entry.is_dir():
+                            pending.append((entry.path, destination))
+                        elif skip_unchanged and self.same(entry, destination):
+                            skipped += 1
+                        else:
+                            size += self.copy_file(control, entry.path,
+                                                   destination)
+                            files += 1
+            elapsed = max(time.time() - started, 0.001)
+            args = [
+                where.replace("\\", "/"),
+                files,
+                size,
+                elapsed,
+                files / elapsed,
+                size / elapsed / 1024 / 1024,
+            ]
+            pattern = "%s: copied %d files (%d bytes) in %.1f seconds"
+            pattern += " (%.1f files/sec, %.1f MB/sec)"
+            if skip_unchanged:
+                pattern += "; %d unchanged files skipped"
+                args.append(skipped)
+            control.logger.info(pattern, *args)
+            control.record("copy", where, elapsed, files, size)
+            return files, size
+
+        @staticmethod
+        def copy_file(control, source, destination):
+            """
+            Copy a single file, preserving its timestamps.
+
+            We use a larger buffer than the default, which speeds up
+            copying to and from network shares. Only the timestamps
+            are carried over; permissions are handled separately by
+            the fix-permissions script.
+
+            Pass:
+              control - access to runtime options
+              source - path to the file to be copied
+              destination - where the copy goes
+
+            Return:
+              number of bytes copied
+            """
+
+            buffer_size = control.opts.buffer * 1024
+            with open(source, "rb") as src, open(destination, "wb") as dst:
+                shutil.copyfileobj(src, dst, buffer_size)
+            stat = os.stat(source)
+            os.utime(destination, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+            return stat.st_size
+
+        @staticmethod
+        def same(entry, path):
+            """
+            Find out if a file appears to be unchanged.
+
+            We allow for file systems which don't store fractions of
+            a second in file timestamps.
+
+            Pass:
+              entry - `os.DirEntry` object for the source file
+              path - location of the destination file
+
+            Return:
+              True if the sizes and modification times match
+            """
+
+            try:
+                old = os.stat(path)
+            except OSError:
+                return False
+            new = entry.stat()
+            if new.st_size != old.st_size:
+                return False
+            return int(new.st_mtime) == int(old.st_mtime)
+
+        def sync(self, control, source, target, prune=True):
+            """
+            Bring an existing directory in line with the build set.
+
+            Only files which are new or whose content has changed are
+            copied. Files (and directories) which are no longer in the
+            build set are removed, unless `prune` is False (used for
+            the parts of the web server tree which hold files not
+            under version control). A summary of what was changed is
+            logged for each subdirectory affected.
+
+            Pass:
+              control - access to the logger
+              source - path to the directory in the build set
+              target - path to the directory being updated
+              prune - if False, leave files not in the build set alone
+            """
+
+            started = time.time()
+            new_dirs, new_files = self.catalog(source)
+            old_dirs, old_files = self.catalog(target)
+            summary = {}
+            unchanged = files = size = 0
+            for key, path in new_files.items():
+                destination = os.path.join(target, path)
+                if key not in old_files:
+                    action = "added"
+                elif self.differ(control, os.path.join(source, path),
+                                 destination):
+                    action = "changed"
+                    destination = os.path.join(target, old_files[key])
+                else:
+                    unchanged += 1
+                    continue
+                directory = os.path.dirname(destination)
+                if not os.path.isdir(directory):
+                    os.makedirs(directory)
+                size += self.copy_file(control, os.path.join(source, path),
+                                       destination)
+                files += 1
+                self.tally(summary, path, action)
+            for key, path in new_dirs.items():
+                if key not in old_dirs:
+                    directory = os.path.join(target, path)
+                    if not os.path.isdir(directory):
+                        os.makedirs(directory)
+            if prune:
+                for key, path in old_files.items():
+                    if key not in new_files:
+                        os.remove(os.path.join(target, path))
+                        self.tally(summary, path, "removed")
+                for key in sorted(old_dirs, reverse=True):
+                    if key not in new_dirs:
+                        shutil.rmtree(os.path.join(target, old_dirs[key]))
+            name = target.replace("\\", "/")
+            pattern = "%s: %d added, %d changed, %d removed"
+            for directory in sorted(summary):
+                path = "/".join([name, directory]) if directory else name
+                counts = summary[directory]
+                added, changed = counts["added"], counts["changed"]
+                removed = counts["removed"]
+                control.logger.info(pattern, path, added, changed, removed)
+            if not summary:
+                control.logger.info("%s: %d files unchanged", name, unchanged)
+            control.record("sync", target, time.time() - started, files, size)
+
+        @classmethod
+        def catalog(cls, path):
+            """
+            Find all the directories and files in a tree.
+
+            The keys for the returned dictionaries are case-normalized
+            for the platform (so the comparisons work as Windows would
+            expect), and the values are the relative paths as they
+            are actually stored.
+
+            Pass:
+              path - location of the tree
+
+            Return:
+              sequence of dictionaries for subdirectories and for files
+            """
+
+            dirs = {}
+            files = {}
+            for base, subdirs, filenames in os.walk(path):
+                for names, found in ((subdirs, dirs), (filenames, files)):
+                    for name in names:
+                        relpath = os.path.relpath(os.path.join(base, name),
+                                                  path)
+                        found[os.path.normcase(relpath)] = relpath
+            return dirs, files
+
+        def differ(self, control, source, target):
+            """
+            Determine whether a file's content has changed.
+
+            Avoid reading the files if the sizes tell us the answer.
+            If the build set's manifest has the checksum for the file,
+            and the file's size and modification time still match what
+            the manifest recorded (so it hasn't been patched since the
+            build), we only need to read the deployed copy.
+
+            Pass:
+              control - access to the build set's manifest
+              source - path to the file in the build set
+              target - path to the deployed copy of the file
+
+            Return:
+              True if the target is missing or its content is different
+            """
+
+            if not os.path.isfile(target):
+                return True
+            stat = os.stat(source)
+            if stat.st_size != os.path.getsize(target):
+                return True
+            top = os.path.join(control.opts.source, self.name)
+            relpath = os.path.relpath(source, top).replace("\\", "/")
+            info = control.manifest.get(self.name, {}).get(relpath) or {}
+            recorded = info.get("size"), info.get("mtime")
+            if recorded == (stat.st_size, int(stat.st_mtime)):
+                return info.get("sha256") != self.digest(target)
+            return self.digest(source) != self.digest(target)
+
+        @classmethod
+        def digest(cls, path):
+            """
+            Calculate a checksum for a file's content.
+            """
+
+            sha256 = hashlib.sha256()
+            with open(path, "rb") as fp:
+                block = fp.read(cls.BLOCK_SIZE)
+                while block:
+                    sha256.update(block)
+                    block = fp.read(cls.BLOCK_SIZE)
+            return sha256.hexdigest()
+
+        @staticmethod
+        def tally(summary, path, action):
+            """
+            Count a change to a file in the summary for its directory.
+            """
+
+            directory = os.path.dirname(path).replace("\\", "/")
+            if directory not in summary:
+                summary[directory] = dict(added=0, changed=0, removed=0)
+            summary[directory][action] += 1
 
         @classmethod
         def all_dirs(cls):
@@ -15,10 +15,14 @@ JIRA::OCECDR-4300
 """
 
 import argparse
+import hashlib
 import os
+import queue
 import re
 import subprocess
 import sys
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from lxml import etree
 import cdr
 import cdrapi.db as cdrdb
 
@@ -33,8 +37,12 @@ class DocumentSet:
     Attributes:
       logger - object for recording what we do
       opts - runtime control settings
-      session - authority to add/update documents being installed
+      sessions - authority to add/update documents being installed
+                 (one login for each concurrent job, created only
+                 once we know there are documents to be installed)
+      session_pool - queue of sessions not in use by a job
       cursor - for running guest CDR database queries
+      existing - index of the documents already in the repository
     """
 
     DOCTYPE = ACCOUNT = None  # Overridden in the derived classes
@@ -52,16 +60,16 @@ class DocumentSet:
 
         self.logger = cdr.Logging.get_logger("deploy", console=True)
         self.opts = opts
-        self.session = self.login()
+        self.sessions = []
+        self.session_pool = queue.Queue()
         self.cursor = cdrdb.connect(name="CdrGuest").cursor()
+        self.existing = {}
 
     def login(self):
         """
         Create a CDR login session for adding/updating the documents.
         """
 
-        if self.opts.test:
-            return None
         password = cdr.getpw(self.ACCOUNT)
         if not password:
             self.logger.error("account password not found")
@@ -85,27 +93,146 @@ class DocumentSet:
         doctype = self.DOCTYPE.lower()
         self.logger.info("%s %ss", action, doctype)
         self.logger.info("from %s", opts.source)
-        changes = 0
+        self.existing = self.load_existing()
+        docs = []
         for name in os.listdir(self.opts.source):
             if name.endswith(".xml"):
                 xml = open(os.path.join(self.opts.source, name), "rb").read()
-                doc = self.Document(self, name, xml)
-                if doc.install():
-                    changes += 1
+                docs.append(self.Document(self, name, xml))
+        if self.opts.canonical:
+            for doc in docs:
+                doc.digest = self.digest(doc.xml)
+                if doc.old is not None:
+                    doc.old_digest = self.digest(doc.old)
+        docs = [doc for doc in docs if not doc.id or doc.changed()]
+        changes = self.install(docs)
         if changes:
             if not self.opts.test:
                 self.post_process()
         else:
             self.logger.info("%ss already up to date", doctype)
         if not self.opts.test:
-            cdr.logout(self.session)
             self.logger.info("%s installation complete", doctype)
 
+    def install(self, docs):
+        """
+        Install the new and changed documents, several at a time.
+
+        We only log in (once for each job, but no more often than
+        there are documents to install) when there's work to be done,
+        and the sessions are closed whether the installation succeeds
+        or not. The first failure stops the queueing of any more
+        documents, and once the jobs already running are done, we
+        bail out.
+
+        Pass:
+          docs - sequence of new or changed `Document` objects
+
+        Return:
+          number of documents which were (or would be) added or replaced
+        """
+
+        if not docs:
+            return 0
+        jobs = min(self.opts.jobs, len(docs))
+        try:
+            if not self.opts.test:
+                for _ in range(jobs):
+                    session = self.login()
+                    self.sessions.append(session)
+                    self.session_pool.put(session)
+            changes = 0
+            failed = False
+            executor = ThreadPoolExecutor(max_workers=jobs)
+            futures = [executor.submit(doc.install) for doc in docs]
+            for future in as_completed(futures):
+                try:
+                    if future.result():
+                        changes += 1
+                except self.Failure:
+                    failed = True
+                except Exception:
+                    self.logger.exception("document installation failure")
+                    failed = True
+                if failed:
+                    break
+            executor.shutdown(cancel_futures=failed)
+            if failed:
+                sys.exit(1)
+            return changes
+        finally:
+            self.logout()
+
+    def logout(self):
+        """
+        Close all of the login sessions used for installing the documents.
+        """
+
+        while self.sessions:
+            cdr.logout(self.sessions.pop())
+
+    def load_existing(self):
+        """
+        Fetch all of the stored documents of this type in a single query.
+
+        Return:
+          dictionary of (id, xml) tuple lists indexed by normalized title
+        """
+
+        query = cdrdb.Query("document d", "d.id", "d.title", "d.xml")
+        query.join("doc_type t", "t.id = d.doc_type")
+        query.where(query.Condition("t.name", self.DOCTYPE))
+        existing = {}
+        for doc_id, title, xml in query.execute(self.cursor).fetchall():
+            key = self.title_key(title)
+            existing.setdefault(key, []).append((doc_id, xml))
+        return existing
+
+    @staticmethod
+    def digest(xml):
+        """
+        Create a fingerprint of the canonical (C14N) form of a document.
+
+        Attribute order, namespace declarations, quoting, empty element
+        syntax, and line endings don't affect the fingerprint. Whitespace
+        inside the document does, because for filters it can matter.
+
+        Pass:
+          xml - serialized document (bytes or string)
+
+        Return:
+          hex string for the SHA-256 hash, or None if the XML won't parse
+        """
+
+        if isinstance(xml, str):
+            xml = xml.encode("utf-8")
+        try:
+            root = etree.fromstring(xml.strip())
+        except Exception:
+            return None
+        canonical = etree.tostring(etree.ElementTree(root), method="c14n")
+        return hashlib.sha256(canonical).hexdigest()
+
+    @staticmethod
+    def title_key(title):
+        """
+        Normalize a title the way the database compares them.
+
+        Title matching in SQL Server ignores case and trailing blanks.
+        """
+
+        return (title or "").rstrip().lower()
+
     def post_process(self):
         """
         Override in the derived class as appropriate.
         """
 
+    class Failure(Exception):
+        """
+        Raised (after logging the error) when a document can't be saved.
+        """
+
     @staticmethod
     def fetch_options():
         """
@@ -119,7 +246,13 @@ class DocumentSet:
         parser.add_argument("doctype", choices=doctypes)
         parser.add_argument("--test", "-t", action="store_true",
                             help="don't store, just compare and report")
+        parser.add_argument("--canonical", "-c", action="store_true",
+                            help="ignore differences which C14N erases")
+        parser.add_argument("-j", "--jobs", type=int, default=4,
+                            help="number of documents to install at once")
         opts = parser.parse_args()
+        if opts.jobs < 1:
+            parser.error("--jobs must be at least 1")
         return opts
 
     @classmethod
@@ -152,17 +285,18 @@ class DocumentSet:
             self.control = control
             self.doctype = control.DOCTYPE
             self.id = self.old = None
+            self.digest = self.old_digest = None
 
         def fetch_doc(self):
             """
             Retrieve the document ID and stored XML if not new.
+
+            The stored documents were all loaded up front by `run()`,
+            so this is a lookup in that index, not a database query.
             """
 
-            query = cdrdb.Query("document d", "d.id", "d.xml")
-            query.join("doc_type t", "t.id = d.doc_type")
-            query.where(query.Condition("t.name", self.doctype))
-            query.where(query.Condition("d.title", self.title))
-            rows = query.execute(self.control.cursor).fetchall()
+            key = self.control.title_key(self.title)
+            rows = self.control.existing.get(key)
             if not rows:
                 return
             if len(rows) > 1:
@@ -187,9 +321,13 @@ class DocumentSet:
             """
             Compare the old and new docs.
 
-            Ignore leading and trailing whitespace differences.
+            Ignore leading and trailing whitespace differences. If the
+            canonical comparison was requested (and both documents are
+            well-formed), compare the fingerprints `run()` calculated.
             """
 
+            if self.digest and self.old_digest:
+                return self.digest != self.old_digest
             old = self.old.strip().replace("\\r", "").encode("utf-8")
             return self.xml.strip() != old
 
@@ -197,7 +335,7 @@ class DocumentSet:
             """
             Add the document to the CDR repository (if not testing).
 
-            Return True, which is bubbled up to the main loop in `run()`.
+            Return True, which is bubbled up to `install()` in the set.
             """
 
             if self.control.opts.test:
@@ -209,11 +347,15 @@ class DocumentSet:
             cdr_doc = str(cdr.Doc(self.xml, **opts))
             opts = dict(doc=cdr_doc, checkIn="Y", ver="Y", comment=comment)
             opts["publishable"] = self.control.PUBLISHABLE
-            cdr_id = cdr.addDoc(self.control.session, **opts)
+            session = self.control.session_pool.get()
+            try:
+                cdr_id = cdr.addDoc(session, **opts)
+            finally:
+                self.control.session_pool.put(session)
             error = cdr.checkErr(cdr_id)
             if error:
                 self.control.logger.error(error)
-                sys.exit(1)
+                raise self.control.Failure(error)
             self.control.logger.info("added %s as %s", self.name, cdr_id)
             return True
 
@@ -221,13 +363,12 @@ class DocumentSet:
             """
             Update an existing CDR document (if not testing).
 
-            Return True, which is bubbled up to the main loop in `run()`.
+            Return True, which is bubbled up to `install()` in the set.
             """
 
             if self.control.opts.test:
                 self.control.logger.info("%s is changed", self.name)
                 return True
-            cdr.checkOutDoc(self.control.session, self.id, force="Y")
             comment = "Updated by install-docset.py"
             ctrl = {"DocTitle": self.title}
             opts = {"type": self.doctype, "encoding": "utf-8", "ctrl": ctrl}
@@ -235,11 +376,16 @@ class DocumentSet:
             cdr_doc = str(cdr.Doc(self.xml, **opts))
             opts = dict(doc=cdr_doc, checkIn="Y", ver="Y", comment=comment)
             opts["publishable"] = self.control.PUBLISHABLE
-            cdr_id = cdr.repDoc(self.control.session, **opts)
+            session = self.control.session_pool.get()
+            try:
+                cdr.checkOutDoc(session, self.id, force="Y")
+                cdr_id = cdr.repDoc(session, **opts)
+            finally:
+                self.control.session_pool.put(session)
             error = cdr.checkErr(cdr_id)
             if error:
                 self.control.logger.error(error)
-                sys.exit(1)
+                raise self.control.Failure(error)
             self.control.logger.info("replaced %s (%s)", self.name, cdr_id)
             return True
 
@@ -285,9 +431,13 @@ class SchemaSet(DocumentSet):
     def refresh_manifest(self):
         """
         Make sure the client manifest refrects changes to the DTDs
+
+        Ask for the delta from the previous manifest, so clients can
+        pick up the new DTDs (and anything else which came with the
+        release) with a single download.
         """
 
-        args = cdr.PYTHON, self.REFRESH_MANIFEST
+        args = cdr.PYTHON, self.REFRESH_MANIFEST, "--delta"
         result = self.execute(args)
         if result.code:
             self.logger.error("failure refreshing manifest: %s", result.output)
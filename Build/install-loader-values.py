@@ -5,9 +5,14 @@
 These are values used by ElasticSearch index loaders. The values will be
 in files contained in a single directory (typically Database/Loader from
 a branch of the cdr-server GitHub repository).
+
+The active `ctl` rows for the groups involved are fetched in a single
+query, and only values which are new or have actually changed are
+stored. Use --dry-run to see what would be changed without storing.
 """
 
 from argparse import ArgumentParser
+from difflib import unified_diff
 from json import load, dumps
 from pathlib import Path
 from cdrapi import db
@@ -16,6 +21,12 @@ from cdr import getpw, login, updateCtl, Logging
 ACCOUNT = "ReleaseInstaller"
 EXTENSIONS = "json", "txt"
 
+
+def normalize(value):
+    """Ignore differences in line endings when comparing values."""
+    return (value or "").replace("\r\n", "\n")
+
+
 logger = Logging.get_logger("deploy", console=True)
 parser = ArgumentParser()
 parser.add_argument("--directory", "-d", required=True)
@@ -24,18 +35,14 @@ parser.add_argument("--session", "-s")
 parser.add_argument("--group", "-g")
 parser.add_argument("--name", "-n")
 parser.add_argument("--verbose", "-v", action="store_true")
+parser.add_argument("--dry-run", "-r", action="store_true",
+                    help="show the differences without storing anything")
 opts = parser.parse_args()
 logger.info("installing from %s", opts.directory)
 try:
-    if opts.session:
-        session = opts.session
-    else:
-        password = getpw(ACCOUNT)
-        session = login(ACCOUNT, password)
-    cursor = db.connect(user="CdrGuest", tier=opts.tier).cursor()
+    values = {}
     directory = Path(opts.directory)
-    update_opts = dict(tier=opts.tier)
-    for path in directory.iterdir():
+    for path in sorted(directory.iterdir()):
         if path.is_file():
             name = path.name
             parts = name.split(".")
@@ -47,20 +54,52 @@ try:
                         group, name = parts
                         if not opts.name or opts.name == name:
                             if not opts.group or opts.group == group:
-                                logger.info("group=%s name=%s", group, name)
                                 value = path.read_text("utf-8")
-                                query = db.Query("ctl", "comment")
-                                query.where(query.Condition("grp", group))
-                                query.where(query.Condition("name", name))
-                                query.where("inactivated IS NULL")
-                                rows = query.execute(cursor).fetchall()
-                                comment = rows[0].comment if rows else None
-                                if opts.verbose:
-                                    print(f"{group}:{name}={comment}")
-                                update_opts["group"] = group
-                                update_opts["name"] = name
-                                update_opts["value"] = value
-                                update_opts["comment"] = comment
-                                updateCtl(session, "Create", **update_opts)
+                                values[(group, name)] = value
+    current = {}
+    if values:
+        cursor = db.connect(user="CdrGuest", tier=opts.tier).cursor()
+        groups = sorted({group for group, name in values})
+        query = db.Query("ctl", "grp", "name", "val", "comment")
+        query.where(query.Condition("grp", groups, "IN"))
+        query.where("inactivated IS NULL")
+        for row in query.execute(cursor).fetchall():
+            current[(row.grp, row.name)] = row
+    changes = []
+    for key, value in values.items():
+        row = current.get(key)
+        if row and normalize(row.val) == normalize(value):
+            continue
+        changes.append(key)
+        if opts.dry_run:
+            group, name = key
+            if row is None:
+                print(f"new value for {group}:{name}")
+            else:
+                old = normalize(row.val).splitlines(keepends=True)
+                new = normalize(value).splitlines(keepends=True)
+                label = f"{group}--{name}"
+                diff = unified_diff(old, new, f"ctl/{label}", f"file/{label}")
+                print("".join(diff), end="")
+    args = len(values), len(changes)
+    logger.info("%d loader values, %d new or changed", *args)
+    if changes and not opts.dry_run:
+        if opts.session:
+            session = opts.session
+        else:
+            password = getpw(ACCOUNT)
+            session = login(ACCOUNT, password)
+        update_opts = dict(tier=opts.tier)
+        for group, name in changes:
+            logger.info("group=%s name=%s", group, name)
+            row = current.get((group, name))
+            comment = row.comment if row else None
+            if opts.verbose:
+                print(f"{group}:{name}={comment}")
+            update_opts["group"] = group
+            update_opts["name"] = name
+            update_opts["value"] = values[(group, name)]
+            update_opts["comment"] = comment
+            updateCtl(session, "Create", **update_opts)
 except Exception as e:
     logger.exception("installing loader values")
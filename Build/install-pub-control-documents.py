@@ -1,9 +1,22 @@
 #!/usr/bin/env python
 
 """Update publishing control documents for a release deployment.
+
+The XML of the last publishable version of each of the publishing
+control documents is fetched in a single query, and only the documents
+whose files differ from that version (ignoring differences which
+canonical XML erases) are saved, several at a time. Comparing with the
+publishable version rather than the working copy means a document whose
+working copy happens to match the file, but whose new version was never
+saved as publishable, still gets installed.
 """
 
+from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
+from queue import Queue
+import sys
+from lxml import etree
 from cdr import Logging
 from cdrapi import db
 from cdrapi.docs import Doc
@@ -21,19 +34,97 @@ OPTIONS = dict(
     val_types=("schema", "links"),
 )
 
-logger = Logging.get_logger("deploy")
-tier = Tier()
-session = Session.create_session(ACCOUNT, password=tier.password(ACCOUNT))
-query = db.Query("document d", "d.id", "d.title")
-query.join("doc_type t", "t.id = d.doc_type")
-query.where("t.name = 'PublishingSystem'")
-for doc_id, doc_title in query.execute().fetchall():
-    path = Path(f"{tier.basedir}/Publishing/{doc_title}.xml")
-    if path.exists():
+
+def normalize(xml):
+    """
+    Prepare a document for comparison.
+
+    Pass:
+      xml - serialized document string
+
+    Return:
+      canonical (C14N) form of the document if it is well-formed;
+      otherwise the string, without line ending or edge whitespace
+      differences
+    """
+
+    xml = (xml or "").replace("\r\n", "\n").strip()
+    try:
+        root = etree.fromstring(xml.encode("utf-8"))
+        return etree.tostring(etree.ElementTree(root), method="c14n")
+    except Exception:
+        return xml
+
+
+def install(doc_id, xml):
+    """
+    Save a new version of a publishing control document.
+
+    Pass:
+      doc_id - integer for the document's CDR ID
+      xml - new serialized document to be stored
+    """
+
+    session = sessions.get()
+    try:
         doc = Doc(session, id=doc_id)
         args = doc.cdr_id, doc.title
         logger.info("installing publishing control doc %s (%s)", *args)
         print(f"updating publishing control doc {doc.cdr_id} ({doc.title})")
         doc.check_out(force=True, comment=COMMENT)
-        doc.xml = path.read_text(encoding="utf-8")
+        doc.xml = xml
         doc.save(**OPTIONS)
+    finally:
+        sessions.put(session)
+
+
+parser = ArgumentParser()
+parser.add_argument("--jobs", "-j", type=int, default=3,
+                    help="number of documents to install at once")
+opts = parser.parse_args()
+if opts.jobs < 1:
+    parser.error("--jobs must be at least 1")
+logger = Logging.get_logger("deploy")
+tier = Tier()
+query = db.Query("document d", "d.id", "d.title", "v.xml")
+query.join("doc_type t", "t.id = d.doc_type")
+query.outer("doc_version v", "v.id = d.id", "v.publishable = 'Y'",
+            "v.num = (SELECT MAX(num) FROM doc_version"
+            " WHERE id = d.id AND publishable = 'Y')")
+query.where("t.name = 'PublishingSystem'")
+changed = []
+for doc_id, doc_title, doc_xml in query.execute().fetchall():
+    path = Path(f"{tier.basedir}/Publishing/{doc_title}.xml")
+    if path.exists():
+        xml = path.read_text(encoding="utf-8")
+        if normalize(xml) == normalize(doc_xml):
+            logger.info("publishing control doc %s unchanged", doc_title)
+        else:
+            changed.append((doc_id, xml))
+sessions = Queue()
+logins = []
+jobs = min(opts.jobs, len(changed))
+failures = 0
+try:
+    for _ in range(jobs):
+        password = tier.password(ACCOUNT)
+        logins.append(Session.create_session(ACCOUNT, password=password))
+        sessions.put(logins[-1])
+    with ThreadPoolExecutor(max_workers=max(jobs, 1)) as executor:
+        futures = {}
+        for doc_id, xml in changed:
+            futures[executor.submit(install, doc_id, xml)] = doc_id
+    for future, doc_id in futures.items():
+        try:
+            future.result()
+        except Exception:
+            logger.exception("failure installing CDR%d", doc_id)
+            failures += 1
+finally:
+    for session in logins:
+        session.logout()
+args = len(changed), failures
+logger.info("%d changed publishing control docs, %d failed", *args)
+if failures:
+    print(f"{failures} publishing control doc(s) failed; see the log")
+    sys.exit(1)
@@ -8,20 +8,44 @@
 # to be preserved, name those document types on the command line.
 #
 # Usage:
-#   PullDevData.py [newdoctype [newdoctype ...] ]
+#   PullDevData.py [--jobs N] [--since-snapshot DIR]
+#                  [newdoctype [newdoctype ...] ]
+#
+# With --since-snapshot, only the documents which the audit_trail table
+# shows were added or modified since that earlier snapshot was taken are
+# exported. Unchanged documents are hard-linked (or copied) from the
+# older snapshot, and the IDs of documents which no longer exist are
+# listed by type in deleted.json. The tables and the test documents are
+# always pulled in full.
+#
+# The tables and document types are exported concurrently, each into its
+# own output, over a small pool of read-only (CdrGuest) connections, and
+# the row count and elapsed time for each is reported at the end.
+#
+# The output is one repr()-ed file per document and one repr()-ed line
+# per table row, which is what the cdr_dev_data loader used by
+# PushDevData.py and CheckDevData.py reads. Table rows are fetched in
+# batches, so memory use doesn't grow with the size of the table.
 #
 # ---------------------------------------------------------------------
 
 import datetime
+import json
 import os
 import re
+import shutil
 import sys
 import time
+from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
+from queue import Queue
 from cdr import run_command
 from cdrapi import db
 from pathlib import Path
 
 DUMP_JOBS = f"python {sys.path[0]}/dump-scheduled-jobs.py"
+FETCH_SIZE = 500
+SINCE_MARGIN = datetime.timedelta(hours=1)
 
 # ---------------------------------------------------------------------
 # Ensure only documents with unique title are being preserved
@@ -89,11 +113,14 @@ def saveDocs(cursor, outputDir, docType):
     if not row:
         raise Exception(f"no documents found of type {docType}")
 
+    count = 0
     while row:
         fp = open(f"{outputDir}/{docType}/{row[0]}.cdr", "w", encoding="utf-8")
         fp.write(repr(row))
         fp.close()
+        count += 1
         row = cursor.fetchone()
+    return count
 
 
 # ---------------------------------------------------------------------
@@ -152,6 +179,19 @@ def saveTestDocs(cursor, outputDir):
         row = cursor.fetchone()
 
 
+# ---------------------------------------------------------------------
+# Fetch the rows of a query result without loading all of them at once.
+# ---------------------------------------------------------------------
+def streamRows(cursor):
+    """ Yield the rows of a query result in fetchmany() batches. """
+    while True:
+        rows = cursor.fetchmany(FETCH_SIZE)
+        if not rows:
+            break
+        for row in rows:
+            yield row
+
+
 # ---------------------------------------------------------------------
 # Save a table.  First line of output is the list of column names.
 # Subsequent lines are the contents of each table row, one per line.
@@ -162,14 +202,136 @@ def saveTable(cursor, outputDir, tableName):
     cursor.execute(f"SELECT * FROM {tableName}")
     fp = open(f"{outputDir}/tables/{tableName}", "w", encoding="utf-8")
     fp.write("%s\n" % repr([col[0] for col in cursor.description]))
-    for row in cursor.fetchall():
+    count = 0
+    for row in streamRows(cursor):
         values = []
         for value in row:
             if isinstance(value, datetime.datetime):
                 value = str(value)
             values.append(value)
         fp.write("%s\n" % repr(tuple(values)))
+        count += 1
     fp.close()
+    return count
+
+
+# ---------------------------------------------------------------------
+# When was an earlier snapshot taken?
+# ---------------------------------------------------------------------
+def snapshotTime(snapshotDir):
+    """ Use the time stamp in the directory name this script gives every
+        snapshot, backing off by SINCE_MARGIN so differences between this
+        machine's clock and the database server's can't make us miss a
+        change.
+    """
+
+    name = os.path.basename(os.path.normpath(snapshotDir))
+    started = datetime.datetime.strptime(name, "DevData-%Y%m%d%H%M%S")
+    return started - SINCE_MARGIN
+
+
+# ---------------------------------------------------------------------
+# Save the documents of a type which changed since an earlier snapshot.
+# ---------------------------------------------------------------------
+def saveDocsSince(cursor, outputDir, docType, oldDir, since, deleted):
+    """ Export the documents of this type which have been added or
+        modified since the earlier snapshot in `oldDir` (or which are
+        missing from it), carry over the rest from that snapshot, and
+        record the IDs of the documents which have gone away in the
+        `deleted` dictionary.  The output has the same layout as
+        saveDocs() would produce.  Returns the document count.
+    """
+
+    print(f"Saving changes to document type {docType}")
+    cursor.execute("""\
+    SELECT d.id
+      FROM document d
+      JOIN doc_type t
+        ON t.id = d.doc_type
+     WHERE t.name = ?""", docType)
+    current = {row[0] for row in cursor.fetchall()}
+    if not current:
+        raise Exception(f"no documents found of type {docType}")
+    old = set()
+    if os.path.isdir(f"{oldDir}/{docType}"):
+        for name in os.listdir(f"{oldDir}/{docType}"):
+            if name.endswith(".cdr"):
+                old.add(int(name[:-4]))
+    cursor.execute("""\
+    SELECT DISTINCT a.document
+      FROM audit_trail a
+      JOIN document d
+        ON d.id = a.document
+      JOIN doc_type t
+        ON t.id = d.doc_type
+     WHERE t.name = ?
+       AND a.dt >= ?""", docType, since)
+    changed = {row[0] for row in cursor.fetchall()} & current
+    changed |= current - old
+    unchanged = current - changed
+    deleted[docType] = sorted(old - current)
+
+    # Export the new and modified documents.
+    # --------------------------------------
+    os.mkdir(f"{outputDir}/{docType}")
+    ids = sorted(changed)
+    for start in range(0, len(ids), FETCH_SIZE):
+        batch = ids[start:start+FETCH_SIZE]
+        placeholders = ", ".join("?" * len(batch))
+        cursor.execute(f"""\
+    SELECT id, title, xml
+      FROM document
+     WHERE id IN ({placeholders})""", *batch)
+        for row in cursor.fetchall():
+            path = f"{outputDir}/{docType}/{row[0]}.cdr"
+            Path(path).write_text(repr(row), encoding="utf-8")
+
+    # Carry over the rest from the earlier snapshot.
+    # ----------------------------------------------
+    for docId in unchanged:
+        source = f"{oldDir}/{docType}/{docId}.cdr"
+        target = f"{outputDir}/{docType}/{docId}.cdr"
+        try:
+            os.link(source, target)
+        except OSError:
+            shutil.copy2(source, target)
+    args = docType, len(changed), len(unchanged), len(deleted[docType])
+    print("       %s: %d changed, %d unchanged, %d deleted" % args)
+    return len(current)
+
+
+# ---------------------------------------------------------------------
+# Run the table and document type exports concurrently.
+# ---------------------------------------------------------------------
+def export(tasks, jobs):
+    """ Each task is a (kind, name, function, args) tuple, where the
+        function takes a cursor followed by the args and returns the
+        number of rows it saved.  Each worker borrows one of a pool of
+        read-only connections.  Returns a list of (kind, name, count,
+        seconds) tuples in task order; the first failure is raised once
+        all of the exports have finished.
+    """
+
+    cursors = Queue()
+    for _ in range(min(jobs, len(tasks))):
+        cursors.put(db.connect(user="CdrGuest").cursor())
+
+    def run(kind, name, function, args):
+        cursor = cursors.get()
+        try:
+            start = time.time()
+            count = function(cursor, *args)
+            return kind, name, count, time.time() - start
+        finally:
+            cursors.put(cursor)
+
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        futures = [executor.submit(run, *task) for task in tasks]
+    results = [future.result() for future in futures]
+    print("Export summary")
+    for kind, name, count, elapsed in results:
+        print(f"  {kind:8} {name:25} {count:8d} rows {elapsed:8.2f} seconds")
+    return results
 
 
 # ---------------------------------------------------------------------
@@ -191,6 +353,23 @@ def saveJobs(outputDir):
 # Do the work.
 # ---------------------------------------------------------------------
 def main():
+    parser = ArgumentParser()
+    parser.add_argument("--jobs", "-j", type=int, default=4,
+                        help="number of tables/doctypes to export at once")
+    parser.add_argument("--since-snapshot", metavar="DIR",
+                        help="only export documents changed since then")
+    parser.add_argument("doctypes", nargs="*", metavar="newdoctype")
+    opts = parser.parse_args()
+    if opts.jobs < 1:
+        parser.error("--jobs must be at least 1")
+    oldDir = opts.since_snapshot
+    if oldDir:
+        if not os.path.isdir(oldDir):
+            parser.error(f"{oldDir} not found")
+        try:
+            since = snapshotTime(oldDir)
+        except Exception:
+            parser.error(f"can't tell when {oldDir} was taken")
     pull_tables = ("action",         "active_status",
                    "ctl",            "doc_type",
                    "filter_set",     "filter_set_member",
@@ -201,7 +380,9 @@ def main():
                    "link_xml",       "query",
                    "query_term_def", "query_term_rule",
                    "usr")
-    outputDir = time.strftime('DevData-%Y%m%d%H%M%S')
+    docTypes = ["Filter", "PublishingSystem", "Schema"] + opts.doctypes
+    started = datetime.datetime.now().replace(microsecond=0)
+    outputDir = started.strftime('DevData-%Y%m%d%H%M%S')
     cursor = db.connect(user="CdrGuest").cursor()
     os.makedirs("%s/tables" % outputDir)
 
@@ -211,10 +392,21 @@ def main():
     # ---------------------
     saveJobs(outputDir)
 
+    tasks = []
     for table in pull_tables:
-        saveTable(cursor, outputDir, table)
-    for docType in ["Filter", "PublishingSystem", "Schema"] + sys.argv[1:]:
-        saveDocs(cursor, outputDir, docType)
+        tasks.append(("table", table, saveTable, (outputDir, table)))
+    deleted = {}
+    for docType in docTypes:
+        if oldDir:
+            args = outputDir, docType, oldDir, since, deleted
+            tasks.append(("doctype", docType, saveDocsSince, args))
+        else:
+            args = outputDir, docType
+            tasks.append(("doctype", docType, saveDocs, args))
+    export(tasks, opts.jobs)
+    if oldDir:
+        with open(f"{outputDir}/deleted.json", "w", encoding="utf-8") as fp:
+            json.dump(deleted, fp, indent=2, sort_keys=True)
 
     # Saving individual test/training documents marked for preserve
     # -------------------------------------------------------------
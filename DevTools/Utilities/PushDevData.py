@@ -12,6 +12,8 @@ work done by developers on the development server.
 
 # Standard libraries
 from argparse import ArgumentParser
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
 
 # Local project libraries
 import cdr
@@ -81,6 +83,8 @@ class Job:
         'PUBLISH DOCUMENT',
         'VALIDATE DOCUMENT',
     )
+    BATCH_SIZE = 1000
+    OUTCOMES = "added", "modified", "skipped", "failed"
 
     def __init__(self):
         """
@@ -106,7 +110,11 @@ class Job:
         parser.add_argument("--skip-content", action="store_true",
                             help="exclude practice documents "
                             "from being restored")
+        parser.add_argument("--jobs", type=int, default=4,
+                            help="number of documents to restore at once")
         opts = parser.parse_args()
+        if opts.jobs < 1:
+            parser.error("--jobs must be at least 1")
 
         # 3. Create objects used to do the job's work.
         self._logger = cdr.Logging.get_logger("PushDevData", console=True)
@@ -121,6 +129,9 @@ class Job:
         self._logger.info("session %s", self._session)
         self._logger.info("using data preserved in %s", self._dir)
         self._new_doc_types = []
+        self._locks = {}
+        self._jobs = opts.jobs
+        self._outcomes = Counter()
 
     def restore_old_doctypes(self):
         """
@@ -138,6 +149,8 @@ class Job:
 
         self._logger.info(msg)
 
+        # Decide what needs to be done before touching anything.
+        plans = {}
         for doc_type in sorted(self._old.docs):
             # 'Old' docs were on DEV before refresh; 'new' are post refresh.
             old = self._old.docs[doc_type].docs
@@ -146,9 +159,11 @@ class Job:
             if new:
                 if self._skip_content and doc_type in Job.CONTENTTYPES:
                     self._logger.info("skipping %r docs", doc_type)
+                    self._outcomes["skipped"] += len(old)
                     continue
                 else:
                     self._logger.info("restoring %r docs", doc_type)
+                plan = plans[doc_type] = []
 
                 # Documents are keyed by unique title.
                 for key in old:
@@ -156,20 +171,35 @@ class Job:
 
                     # If PROD didn't have the document, (re-)create it.
                     if key not in new:
-                        self._logger.info(f"Adding new document '{old_title}'")
-                        self._add_doc(doc_type, old_title, old_xml)
+                        args = doc_type, old_title, old_xml
+                        plan.append((self._add_doc, args))
                     else:
 
                         # PROD had it; if it differs, restore what was on DEV.
                         new_id, new_title, new_xml = new[key]
                         if self._differ(old_xml, new_xml):
-                            self._mod_doc(doc_type, old_title, old_xml, new_id)
+                            args = doc_type, old_title, old_xml, new_id
+                            plan.append((self._mod_doc, args))
+                        else:
+                            self._outcomes["skipped"] += 1
             else:
 
                 # Defer documents for types we have to re-create
                 self._logger.info("deferring %r docs", doc_type)
                 self._new_doc_types.append(doc_type)
 
+        # Clear out other users' locks on the documents we'll modify.
+        ids = []
+        for plan in plans.values():
+            for method, args in plan:
+                if method == self._mod_doc:
+                    ids.append(args[3])
+        self._break_locks(ids)
+
+        # Now do the work, one document type at a time.
+        for doc_type in plans:
+            self._restore(plans[doc_type])
+
     def restore_new_doctypes(self):
         """
         Re-create documents whose doctype was not in the PROD repository.
@@ -179,11 +209,16 @@ class Job:
         """
         self._logger.info("restoring new document types")
         for doc_type in self._new_doc_types:
+            docs = self._old.docs[doc_type].docs
             if self._create_doctype(doc_type):
-                docs = self._old.docs[doc_type].docs
+                plan = []
                 for key in docs:
                     doc_id, doc_title, doc_xml = docs[key]
-                    self._add_doc(doc_type, doc_title, doc_xml)
+                    args = doc_type, doc_title, doc_xml
+                    plan.append((self._add_doc, args))
+                self._restore(plan)
+            else:
+                self._outcomes["failed"] += len(docs)
 
     def clean_up(self):
         """
@@ -193,8 +228,41 @@ class Job:
         # Don't need to close the session.
         # cdr.logout(self._session)
 
+        summary = ", ".join(f"{self._outcomes[o]} {o}" for o in Job.OUTCOMES)
+        self._logger.info("documents: %s", summary)
         self._logger.info("restoration complete")
 
+    def _restore(self, plan):
+        """
+        Add or modify the documents of a single document type concurrently.
+
+        Pass:
+          plan - sequence of (method, args) tuples, where method is
+                 `_add_doc` or `_mod_doc`
+        """
+
+        with ThreadPoolExecutor(max_workers=self._jobs) as executor:
+            futures = []
+            for method, args in plan:
+                if method == self._add_doc:
+                    self._logger.info(f"Adding new document '{args[1]}'")
+                futures.append(executor.submit(self._run, method, args))
+        for future in futures:
+            self._outcomes[future.result()] += 1
+
+    def _run(self, method, args):
+        """
+        Invoke `_add_doc` or `_mod_doc` in a worker thread.
+
+        Return the outcome of the call ("added", "modified" or "failed").
+        """
+
+        try:
+            return method(*args)
+        except Exception:
+            self._logger.exception("failure restoring %r", args[1])
+            return "failed"
+
     def _create_doctype(self, name):
         """
         Create a document type which had been on DEV but not on PROD.
@@ -281,17 +349,20 @@ class Job:
         err = cdr.checkErr(doc_id)
         if err:
             self._logger.error("failure creating document: %s", err)
-            return
+            return "failed"
 
         # Newly created document need to be versioned and unlocked separately.
         doc = self._lock_doc(doc_id)
-        if doc:
-            response = cdr.repDoc(self._session, doc=str(doc), checkIn="Y",
-                                  val="Y", ver="Y", reason=Job.COMMENT,
-                                  comment=Job.COMMENT)
-            err = cdr.checkErr(response)
-            if err:
-                self._logger.error("failure unlocking %s: %s", doc_id, err)
+        if not doc:
+            return "failed"
+        response = cdr.repDoc(self._session, doc=str(doc), checkIn="Y",
+                              val="Y", ver="Y", reason=Job.COMMENT,
+                              comment=Job.COMMENT)
+        err = cdr.checkErr(response)
+        if err:
+            self._logger.error("failure unlocking %s: %s", doc_id, err)
+            return "failed"
+        return "added"
 
     def _mod_doc(self, doc_type, doc_title, doc_xml, doc_id):
         """
@@ -301,31 +372,58 @@ class Job:
         args = doc_type, doc_title, doc_id
         self._logger.info("updating %r document %r (CDR%d)", *args)
 
-        # Lock the document, breaking any existing locks if necessary.
+        # Lock the document (other users' locks were broken up front).
         doc = self._lock_doc(doc_id)
-        if doc:
-
-            # Plug in the preserved XML from PROD and create the new version.
-            doc.xml = doc_xml.encode("utf-8")
-            doc.ctrl["DocTitle"] = doc_title.encode("utf-8")
-            response = cdr.repDoc(self._session, doc=str(doc), checkIn="Y",
-                                  val="Y", ver="Y", reason=Job.COMMENT,
-                                  comment=Job.COMMENT)
-            err = cdr.checkErr(response)
-            if err:
-                args = cdr.normalize(doc_id), err
-                self._logger.error("failure saving %s: %s", *args)
+        if not doc:
+            return "failed"
+
+        # Plug in the preserved XML from PROD and create the new version.
+        doc.xml = doc_xml.encode("utf-8")
+        doc.ctrl["DocTitle"] = doc_title.encode("utf-8")
+        response = cdr.repDoc(self._session, doc=str(doc), checkIn="Y",
+                              val="Y", ver="Y", reason=Job.COMMENT,
+                              comment=Job.COMMENT)
+        err = cdr.checkErr(response)
+        if err:
+            args = cdr.normalize(doc_id), err
+            self._logger.error("failure saving %s: %s", *args)
+            return "failed"
+        return "modified"
+
+    def _break_locks(self, doc_ids):
+        """
+        Release other users' locks on the documents we're going to modify.
+
+        The open checkouts for all of the documents are found with a
+        single query up front, so we don't have to ask about each
+        document separately when we're ready to lock it ourselves.
+        The lock map is left holding only the locks which remain (our
+        own, and any we couldn't break), for `_lock_doc()` to consult.
+        """
+
+        self._locks.update(self._find_lockers(doc_ids))
+        uid = self._uid.lower()
+        others = [i for i in sorted(self._locks) if self._locks[i] != uid]
+        if others:
+            self._logger.info("breaking locks on %d documents", len(others))
+        for doc_id in others:
+            if self._unlock_doc(doc_id):
+                del self._locks[doc_id]
 
     def _lock_doc(self, doc_id):
         """
         Check out an existing CDR document.
+
+        Other users' locks have already been broken by `_break_locks()`,
+        so the lock map tells us whether the document is still locked.
         """
 
-        # If someone else has the document locked, break the lock.
-        locker = self._find_locker(doc_id)
-        if locker and locker.lower() != self._uid.lower():
-            if not self._unlock_doc(doc_id):
-                return None
+        # If someone else still has the document locked, give up on it.
+        locker = self._locks.get(cdr.exNormalize(doc_id)[1])
+        if locker and locker != self._uid.lower():
+            args = cdr.normalize(doc_id), locker
+            self._logger.error("%s is still locked by %s", *args)
+            return None
 
         # Fetch the document with a lock.
         doc = cdr.getDoc(self._session, doc_id, checkout="Y", getObject=True)
@@ -360,20 +458,29 @@ class Job:
         """
         return xml.replace("\r", "")
 
-    def _find_locker(self, id):
+    def _find_lockers(self, ids):
         """
-        Find out who (if anyone) has a specified document checked out.
+        Find out who (if anyone) has each of a set of documents checked out.
+
+        Return a dictionary of lowercase user names indexed by integer
+        document ID, including only documents which are checked out.
         """
-        self._cursor.execute("""\
-            SELECT u.name
+        ids = sorted({cdr.exNormalize(id)[1] for id in ids})
+        lockers = {}
+        for start in range(0, len(ids), Job.BATCH_SIZE):
+            batch = ids[start:start+Job.BATCH_SIZE]
+            placeholders = ", ".join("?" * len(batch))
+            self._cursor.execute(f"""\
+            SELECT c.id, u.name
               FROM usr u
               JOIN checkout c
                 ON c.usr = u.id
-             WHERE c.id = ?
+             WHERE c.id IN ({placeholders})
                AND c.dt_in IS NULL
-          ORDER BY dt_out DESC""", cdr.exNormalize(id)[1])
-        rows = self._cursor.fetchall()
-        return rows and rows[0][0] or None
+          ORDER BY c.dt_out""", batch)
+            for doc_id, name in self._cursor.fetchall():
+                lockers[doc_id] = name.lower()
+        return lockers
 
 
 # ----------------------------------------------------------------------